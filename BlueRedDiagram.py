@@ -1,5 +1,6 @@
 import numpy as np
 import cv2
+import Camera as Cam
 from PIL import Image
 
 
@@ -8,16 +9,8 @@ def screen_cart(Nz, Ny, L = 1):
      #        Ny amount pixels horizontal side screen ,
      #        L = physical width and lenght of the screen.
      # output: 3D matrix (2d matrix of each ray/pixel, containing its location in 3D space)
-    My = np.linspace(-L, L, Ny)
-    Mz = np.linspace(-L, L, Nz)
-
-    #cartesian product My X Mz
-    arr = []
-    for j in range(Nz):
-        for i in range(Ny):
-            # Placed at x = 1, (y,z) in My X Mz
-            arr.append([1, My[i]/2,Mz[j]/2]) #(x, y, z)
-    return np.array(arr).reshape(Nz, Ny, 3) #Flat array into matrix
+     #         placed at x = 1, (y,z) in [-L/2, L/2] X [-L/2, L/2]
+    return Cam.screen_cart(Nz, Ny, L, L, 1)
 
 def cart_Sph(v):
     # input: matrix with cart. coord on first row,
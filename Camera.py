@@ -0,0 +1,120 @@
+import numpy as np
+
+
+def screen_cart(Nz, Ny, L1 = 1, L2 = 2, x = 3.3):
+    # input: Nz amount of pixels on vertical side screen
+    #        Ny amount pixels horizontal side screen ,
+    #        L1, L2 = physical height and width of the screen,
+    #        x: distance of the screen to the camera
+    # output: 3D matrix (2d matrix of each ray/pixel, containing its location in 3D space)
+    My = np.linspace(-L2/2, L2/2, Ny)
+    Mz = np.linspace(-L1/2, L1/2, Nz)
+
+    # cartesian product My X Mz by broadcasting, placed at x, (y,z) in My X Mz
+    S_c = np.empty((Nz, Ny, 3))
+    S_c[..., 0] = x
+    S_c[..., 1] = My
+    S_c[..., 2] = Mz[:, None]
+    return S_c
+
+
+def screen_q(q0, Sh, offset = 0):
+    # input: q0: position of the camera [l, phi, theta],
+    #        Sh: shape of the screen, offset: added to each coordinate
+    # output: read-only view with the position of each ray, coordinates on the
+    #         first axis, without copying q0 for every pixel
+    q0 = np.asarray(q0, dtype=np.float64) + offset
+    return np.broadcast_to(q0.reshape((3,) + (1,)*len(Sh)), (3,) + tuple(Sh))
+
+
+def quat_matrix(quat):
+    # input: quat: unit quaternion (w, x, y, z)
+    # output: 3x3 rotation matrix of the quaternion
+    w, x, y, z = np.asarray(quat, dtype=np.float64)/np.linalg.norm(quat)
+    return np.array([[1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)],
+                     [2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)],
+                     [2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)]])
+
+
+class Pinhole_Camera:
+    """
+    Pinhole camera at a position in the wormhole, the viewing directions are
+    given in the local orthonormal frame (e_l, e_phi, e_theta) of the camera.
+    The directions relative to the camera are computed once, orienting the
+    camera only rotates them with one 3x3 matrix.
+    Input:  - q0: position of the camera [l, phi, theta]
+            - Nz, Ny: number of vertical and horizontal pixels
+            - fov: horizontal field of view [rad], the default spans the width of
+                   the default screen_cart (L2 = 2, x = 3.3), for the pixel
+                   directions of a given screen use screen_camera
+            - fov_z: vertical field of view, by default the pixels are square
+            - forward, up: viewing direction and up direction of the camera in
+                   (e_l, e_phi, e_theta), the default looks at the throat (-e_l)
+                   with theta decreasing upwards, like screen_cart
+            - quat: rotation (w, x, y, z) of the default orientation, used
+                   instead of forward and up
+    """
+
+    def __init__(self, q0, Nz, Ny, fov = 2*np.arctan(1/3.3), fov_z = None, forward = (-1, 0, 0), up = (0, 0, -1), quat = None):
+        self.q0 = np.asarray(q0, dtype=np.float64)
+        self.Nz, self.Ny = Nz, Ny
+        tan_y = np.tan(fov/2)
+        tan_z = tan_y*(Nz - 1)/max(Ny - 1, 1) if fov_z is None else np.tan(fov_z/2)
+        # unit directions relative to the camera: forward, right, down
+        D = np.empty((3, Nz, Ny))
+        D[0] = 1
+        D[1] = np.linspace(-tan_y, tan_y, Ny)
+        D[2] = np.linspace(-tan_z, tan_z, Nz)[:, None]
+        self.D = D/np.linalg.norm(D, axis=0)
+        if quat is None:
+            self.look(forward, up)
+        else:
+            self.rotate(quat)
+
+    def look(self, forward, up):
+        # input: forward, up: viewing and up direction in (e_l, e_phi, e_theta),
+        #        up should not be parallel to forward
+        f = np.asarray(forward, dtype=np.float64)
+        up = np.asarray(up, dtype=np.float64)
+        if not np.linalg.norm(f) > 0:
+            raise ValueError('forward should be a nonzero vector, got ' + str(forward))
+        f = f/np.linalg.norm(f)
+        right = np.cross(f, up)
+        if not np.linalg.norm(right) > 1e-12*np.linalg.norm(up):
+            raise ValueError('up should not be parallel to forward, got forward ' + str(forward) + ' and up ' + str(up))
+        right = right/np.linalg.norm(right)
+        down = np.cross(f, right)
+        self.R = np.array([f, right, down]).T
+
+    def rotate(self, quat):
+        # input: quat: rotation (w, x, y, z) applied to the default orientation
+        self.look((-1, 0, 0), (0, 0, -1))
+        self.R = quat_matrix(quat) @ self.R
+
+    def move(self, q0):
+        # input: q0: new position of the camera [l, phi, theta]
+        self.q0 = np.asarray(q0, dtype=np.float64)
+
+    def directions(self):
+        # output: unit viewing direction of each pixel in (e_l, e_phi, e_theta),
+        #         coordinates on the first axis
+        return np.tensordot(self.R, self.D, 1)
+
+    def S_n(self):
+        # output: directions in the screen convention of inn_mom_DNeg,
+        #         which takes p_l = -S_n[0], p_phi = -r sin(theta) S_n[1], p_th = r S_n[2]
+        n = self.directions()
+        n[:2] *= -1
+        return n
+
+    def q(self, offset = 0):
+        # output: position of each ray as a broadcast view, see screen_q
+        return screen_q(self.q0, (self.Nz, self.Ny), offset)
+
+
+def screen_camera(q0, Nz, Ny, L1 = 1, L2 = 2, x = 3.3, **kwargs):
+    # input: q0: position of the camera, Nz, Ny, L1, L2, x: see screen_cart,
+    #        kwargs: orientation, see Pinhole_Camera
+    # output: Pinhole_Camera with the pixel directions of screen_cart(Nz, Ny, L1, L2, x),
+    #         Simulate_DNeg uses L1 = L2 = 1, simulate_raytracer the defaults
+    return Pinhole_Camera(q0, Nz, Ny, 2*np.arctan(L2/(2*x)), 2*np.arctan(L1/(2*x)), **kwargs)
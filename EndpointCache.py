@@ -0,0 +1,87 @@
+import numpy as np
+import hashlib
+import os
+import Storage as St
+
+
+def canon(x):
+    # input: x: setting of a run (number, string, list, array or tabulated profile)
+    # output: string that is equal for equal settings, arrays are hashed
+    if isinstance(x, np.ndarray):
+        x = np.ascontiguousarray(x)
+        return f'nd({x.dtype.str},{x.shape},{hashlib.sha1(x.tobytes()).hexdigest()})'
+    if isinstance(x, (list, tuple)):
+        return '[' + ','.join(canon(v) for v in x) + ']'
+    if hasattr(x, 'Tab'):
+        # tabulated profile (Metric_Profile)
+        return 'profile' + canon(x.Tab)
+    if isinstance(x, (float, np.floating)):
+        return repr(float(x))
+    if isinstance(x, (bool, np.bool_)):
+        return repr(bool(x))
+    if isinstance(x, (int, np.integer)):
+        return repr(int(x))
+    return repr(x)
+
+
+class Endpoint_Cache:
+    """
+    Persistent cache of geodesic endpoints, one .npz file per run in a
+    directory, named by a hash of the settings of the run. When the files
+    exceed the size budget the least recently used ones are removed (a hit
+    updates the modification time of its file).
+    Input:  - path: directory of the cache
+            - max_bytes: size budget of the directory
+    """
+
+    def __init__(self, path, max_bytes = 2**31):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, **Settings):
+        # input: Settings: everything the endpoints depend on
+        # output: hash of the settings
+        s = ';'.join(f'{k}={canon(Settings[k])}' for k in sorted(Settings))
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, key):
+        # input: key: see key
+        # output: dictionary with the stored arrays or None when missing
+        f = self.file(key)
+        try:
+            with np.load(f, allow_pickle=False) as Data:
+                Out = {k: Data[k] for k in Data.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        os.utime(f)
+        return Out
+
+    def put(self, key, **Arrays):
+        # input: key: see key, Arrays: arrays to store (None values are skipped)
+        # the file is written to a temporary name first, then old entries are
+        # evicted until the directory fits in the budget
+        f = self.file(key)
+        St.atomic_save(f, np.savez, **{k: v for k, v in Arrays.items() if v is not None})
+        self.evict(keep = f)
+
+    def evict(self, keep = None):
+        # removes the least recently used entries until the budget is met
+        Files = [os.path.join(self.path, n) for n in os.listdir(self.path) if n.endswith('.npz')]
+        Stats = sorted((os.stat(n).st_mtime_ns, os.stat(n).st_size, n) for n in Files)
+        total = sum(s for t, s, n in Stats)
+        for t, s, n in Stats:
+            if total <= self.max_bytes:
+                break
+            if n == keep:
+                continue
+            os.remove(n)
+            total -= s
+
+    def clear(self):
+        for n in os.listdir(self.path):
+            if n.endswith('.npz'):
+                os.remove(os.path.join(self.path, n))
@@ -3,61 +3,57 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
-
-
-def dneg_r(l, M , rho, a):
-    # input: scalars
-    # output: scalar
-    # define r(l) for a DNeg wormhole without gravity
-    
-    r = np.empty(l.shape)
-    l_abs = np.abs(l)
-    l_con = l_abs >= a
-    inv_l_con = ~l_con
-    
-    x = 2*(l_abs[l_con] - a)/(np.pi*M)
-    r[l_con] = rho + M*(x*np.arctan2(2*(l_abs[l_con] - a), np.pi*M) - 0.5*np.log(1 + x**2))
-    r[inv_l_con] = rho
-    return r
-
-def dneg_dr_dl(l, M, a):
-    # input:scalars
-    # output: scalar
-    # define derivative of r to l
-    
-    dr_dl = np.empty(l.shape)
-    l_abs = np.abs(l)
-    l_con = l_abs >= a
-    inv_l_con = ~l_con
-    
-    x = 2*(l_abs[l_con] - a)/(np.pi*M)
-    dr_dl[l_con] = (2/np.pi)*np.arctan(x)*np.sign(l[l_con])
-    dr_dl[inv_l_con] = 0
-
-    return dr_dl
+import Symplectic_DNeg as Smpl
 
 
 def imb_f(l, Par):
     #input: 1D array
     #output: 1D array
-    M, rho, a = Par
     #hoogte formule inbedding diagram
-    h = np.sqrt(1 - dneg_dr_dl(l, M, a)**2)
+    h = np.sqrt(1 - Smpl.DNeg_metric(l, Par)[1]**2)
 
     return h
 
 
-def imb_f_int(l, Par):
-    #input: 1D array
-    #output: 1D array
+def imb_f_int(l, Par, z = None):
+    #input: l: 1D array, or 2D array integrated per column (along the first axis)
+    #       z: optional function l -> z(l) (see imb_z_table) used instead of the integral
+    #output: array with the shape of l, Z[i] is the integral of imb_f from l[0] to l[i-1]
+    l = np.asarray(l, dtype=float)
+    Z = np.zeros(l.shape)
+    if len(l) < 3:
+        return Z
 
-    Z = []
+    if z is not None:
+        z_l = z(l[:-1])
+        Z[1:] = z_l - z_l[0]
+        return Z
+
+    # cumulatieve trapeziumregel, imb_f een keer per punt
+    f = imb_f(l, Par)
+    dZ = 0.5*np.diff(l, axis=0)*(f[1:] + f[:-1])
+    np.cumsum(dZ[:-1], axis=0, out=Z[2:])
+    return Z
+
+
+def imb_z_table(Par, L = 1000, N = 2**18):
+    #input: Par: [M, rho, a]
+    #       L, N: the table spans |l| - a in [0, L] with N intervals
+    #output: function l -> z(l) of the DNeg embedding with z(0) = 0
+    M, rho, a = Par
+    # z = l in the throat, outside it is tabulated with the trapezium rule and
+    # continued with the tail imb_f ~ u^(-1/2) of arctan, z is odd in l
+    u = np.linspace(0, L, N+1)
+    f = imb_f(u + a, Par)
+    T = np.concatenate(([0], np.cumsum(0.5*np.diff(u)*(f[1:] + f[:-1]))))
 
-    # integratie voor stijgende l
-    for i in range(len(l)):
-         Z.append(np.trapz(imb_f(l[:i], Par), l[:i], axis= 0))
+    def z(l):
+        l = np.asarray(l, dtype=float)
+        u_l = np.maximum(np.abs(l) - a, 0)
+        Z = np.minimum(np.abs(l), a) + np.interp(u_l, u, T) + 2*f[-1]*np.sqrt(L)*(np.sqrt(np.maximum(u_l, L)) - np.sqrt(L))
+        return np.sign(l)*Z
 
-    return np.array(Z)
+    return z
 
 
 def inb_diagr(I, N , Par, ax = None):
@@ -71,7 +67,7 @@ def inb_diagr(I, N , Par, ax = None):
 
     l = np.linspace(I[0], I[1], N+1) # N+1, want dan N intervallen
     phi = np.linspace(0, 2*np.pi, N)
-    R, PHI = np.meshgrid(dneg_r(l, M, rho, a), phi) # radius is r(l)
+    R, PHI = np.meshgrid(Smpl.DNeg_metric(l, Par)[0], phi) # radius is r(l)
 
     # tile want symmetrisch voor rotaties, onafhankelijk van phi
     # Integraal voor Z richting zoals gedefinieerd in de paper
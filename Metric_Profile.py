@@ -0,0 +1,117 @@
+import numpy as np
+from numba import njit, prange
+import Symplectic_DNeg as Smpl
+
+
+@njit
+def Hermite_ray(l, Met):
+    # input: l: scalar, Met: (l_min, dl, Tab) as in Hermite_loop
+    # output: r(l), dr/dl, d2r/dl2 interpolated from the table
+    l_min, dl, Tab = Met
+    N = Tab.shape[0]
+    s = (l - l_min)/dl
+    if s <= 0:
+        k = 0
+        t = 0.
+    elif s >= N - 1:
+        k = N - 2
+        t = 1.
+    else:
+        k = int(s)
+        t = s - k
+    e = l - (l_min + (k + t)*dl)
+
+    t2 = t*t
+    t3 = t2*t
+    h00 = 2*t3 - 3*t2 + 1
+    h10 = (t3 - 2*t2 + t)*dl
+    h01 = 3*t2 - 2*t3
+    h11 = (t3 - t2)*dl
+
+    dr = h00*Tab[k,1] + h10*Tab[k,2] + h01*Tab[k+1,1] + h11*Tab[k+1,2]
+    d2r = h00*Tab[k,2] + h10*Tab[k,3] + h01*Tab[k+1,2] + h11*Tab[k+1,3]
+    r = h00*Tab[k,0] + h10*Tab[k,1] + h01*Tab[k+1,0] + h11*Tab[k+1,1] + dr*e
+    return r, dr, d2r
+
+
+def Hermite_loop(l, l_min, dl, Tab, r, dr, d2r):
+    # input: l: 1D array of l coordinates, l_min, dl: start and spacing of the table,
+    #        Tab: (N, 4) table with r, r', r'', r''' on each node,
+    #        r, dr, d2r: preallocated 1D arrays with the same length as l
+    # fills r(l), dr/dl, d2r/dl2 with cubic Hermite interpolation, outside of the
+    # table r is extrapolated linearly and r', r'' are held at their end values
+    for i in prange(l.size):
+        r[i], dr[i], d2r[i] = Hermite_ray(l[i], (l_min, dl, Tab))
+
+Hermite_kernel = njit(Hermite_loop)
+Hermite_kernel_par = njit(parallel=True)(Hermite_loop)
+
+
+class Metric_Profile:
+    """
+    Tabulated shape function r(l) of a spherically symmetric wormhole.
+    r, r', r'' (and r''') are evaluated once on a uniform l-grid and looked
+    up with cubic Hermite interpolation, so a profile can be passed as Par to
+    Sympl_DNeg, runge_kutta, inn_mom_DNeg and DNeg_CM instead of [M, rho, a].
+    Input:  - r_f: function l -> (r, r', r'') or (r, r', r'', r''') on a 1D array,
+                   when r''' is missing it is estimated with finite differences
+            - L: the table spans [-L, L]
+            - N: amount of nodes
+    """
+
+    def __init__(self, r_f, L = 1000, N = 2**18):
+        self.l = np.linspace(-L, L, N)
+        self.l_min = float(self.l[0])
+        self.dl = float(self.l[1] - self.l[0])
+        Cols = list(r_f(self.l))
+        if len(Cols) == 3:
+            Cols.append(np.gradient(Cols[2], self.l))
+        self.Tab = np.ascontiguousarray(np.stack(Cols, axis=1), dtype=np.float64)
+        # single ray lookup for kernels such as Symplectic_DNeg.Sympl_adaptive
+        self.ray_f = Hermite_ray
+        self.ray_args = (self.l_min, self.dl, self.Tab)
+
+    def __call__(self, l, r = None, dr = None, d2r = None, parallel = False):
+        # input: l: array (or scalar) of l coordinates,
+        #        r, dr, d2r: optional preallocated C-contiguous float64 buffers
+        #        parallel: evaluate on all cores
+        # output: r(l), dr/dl, d2r/dl2
+        l = np.asarray(l, dtype=np.float64)
+        if r is None:
+            r = np.empty(l.shape)
+        if dr is None:
+            dr = np.empty(l.shape)
+        if d2r is None:
+            d2r = np.empty(l.shape)
+        kernel = Hermite_kernel_par if parallel else Hermite_kernel
+        kernel(l.reshape(-1), self.l_min, self.dl, self.Tab,
+               r.reshape(-1), dr.reshape(-1), d2r.reshape(-1))
+        return r, dr, d2r
+
+
+def DNeg_profile(Par, L = 1000, N = 2**18):
+    # input: Par: [M, rho, a]
+    # output: Metric_Profile of the DNeg wormhole, r''' is known analytically,
+    #         the jump of r'' at |l| = a is smoothed over one cell
+    M, rho, a = Par
+
+    def r_f(l):
+        r, dr, d2r = Smpl.DNeg_metric(l, Par)
+        l_a = np.maximum(np.abs(l) - a, 0)
+        d3r = -2*M*l_a*np.sign(l)/(l_a**2 + (0.5*M*np.pi)**2)**2
+        return r, dr, d2r, d3r
+
+    return Metric_Profile(r_f, L, N)
+
+
+def Ellis_profile(rho, L = 1000, N = 2**18):
+    # input: rho: throat radius
+    # output: Metric_Profile of the Ellis wormhole r(l) = sqrt(l^2 + rho^2)
+    def r_f(l):
+        r = np.sqrt(l**2 + rho**2)
+        dr = l/r
+        d2r = rho**2/r**3
+        d3r = -3*rho**2*l/r**5
+        return r, dr, d2r, d3r
+
+    return Metric_Profile(r_f, L, N)
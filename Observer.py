@@ -0,0 +1,75 @@
+import numpy as np
+import Symplectic_DNeg as Smpl
+import Reduction as Red
+
+
+def ray_invariants(p, q, Par):
+    # input: p, q: momenta and positions of the rays (coordinates on the first axis)
+    # output: H, b, B^2 of each ray, flattened
+    p = np.asarray(p).reshape(3, -1)
+    q = np.asarray(q).reshape(3, -1)
+    r = Smpl.Metric(q[0], Par)[0]
+    # blocks of a single ray
+    H, b, B_2 = Red.sum_invariants(p, q[2], r, 1, p.shape[1])
+    return H, b, B_2
+
+
+class CM_Observer:
+    """
+    Monitors the conservation of H, b and B^2 during Simulate_DNeg without
+    storing the constants of motion of every step. Every `every` steps the
+    invariants of each ray are compared with their initial values and running
+    statistics of the drift are updated: the largest |dH|, |db| and |dB^2|,
+    the largest |dH| of each ray, and a short history of the drift.
+    With Simulate_DNeg(tol=...) the rays take their own steps, so there the
+    observer counts snapshots instead of steps.
+    Input:  - Par: wormhole parameters
+            - every: amount of steps (snapshots with tol) between two observations
+            - pct: percentiles of the drift of the rays kept in the history
+    """
+
+    def __init__(self, Par, every = 100, pct = (50, 90, 99, 100)):
+        self.Par = Par
+        self.every = max(int(every), 1)
+        self.pct = np.asarray(pct, dtype=np.float64)
+        self.Ref = None
+
+    def start(self, p, q):
+        # input: p, q: initial state of all rays, the reference of the drift
+        self.Ref = ray_invariants(p, q, self.Par)
+        self.ray_dH = np.zeros(self.Ref[0].shape)
+        self.max_d = np.zeros(3)
+        self.steps = []
+        self.History = []
+
+    def due(self, i):
+        # input: i: amount of steps taken
+        # output: True when the state after step i should be observed
+        return i % self.every == 0
+
+    def observe(self, i, p, q, Ind = None):
+        # input: i: amount of steps taken, p, q: state of the rays,
+        #        Ind: flat indices of the rays in p, q when only a part is passed,
+        #        without rays (all escaped) nothing is recorded
+        if self.Ref is None:
+            raise ValueError('CM_Observer.start should be called before observe')
+        if np.asarray(p).size == 0:
+            return
+        Ind = slice(None) if Ind is None else Ind
+        D = [np.abs(X - X0[Ind]) for X, X0 in zip(ray_invariants(p, q, self.Par), self.Ref)]
+        # fmax/nanmax: rays that turned into nan do not hide the others
+        self.max_d = np.fmax(self.max_d, [np.nanmax(d, initial=0) for d in D])
+        self.ray_dH[Ind] = np.fmax(self.ray_dH[Ind], D[0])
+        self.steps.append(i)
+        self.History.append(np.nanpercentile(D[0], self.pct))
+
+    def percentiles(self, pct = None):
+        # input: pct: percentiles, by default the ones of the history
+        # output: percentiles over the rays of their largest |dH| so far
+        return np.nanpercentile(self.ray_dH, self.pct if pct is None else pct)
+
+    def stats(self):
+        # output: dictionary with the drift statistics
+        return dict(steps=np.array(self.steps), max_dH=self.max_d[0], max_db=self.max_d[1],
+                    max_dB2=self.max_d[2], pct=self.pct, dH_pct=self.percentiles(),
+                    History=np.array(self.History).reshape(-1, len(self.pct)))
@@ -0,0 +1,84 @@
+import numpy as np
+from numba import njit, prange
+
+
+def Block_loop(A, b0, b1, n0, n1, B):
+    # input: A: (k, N0, N1) array, b0, b1: block sizes, n0, n1: amount of blocks,
+    #        B: (k, n0, n1) zeroed array that receives the sum over each block,
+    #        rays beyond the last block are left out, the last blocks may be partial
+    k, N0, N1 = A.shape
+    for c in prange(k*n0):
+        ch = c//n0
+        i = c - ch*n0
+        for ii in range(i*b0, min((i + 1)*b0, N0)):
+            for jj in range(min(n1*b1, N1)):
+                B[ch, i, jj//b1] += A[ch, ii, jj]
+
+Block_kernel = njit(Block_loop)
+Block_kernel_par = njit(parallel=True)(Block_loop)
+
+
+def Invariants_loop(p, theta, r, b0, b1, n0, n1, B):
+    # input: p: (3, N0, N1) momenta, theta, r: (N0, N1), b0, b1, n0, n1: see Block_loop,
+    #        B: (3, n0, n1) zeroed array that receives the block sums of H, b and B^2
+    N0, N1 = r.shape
+    for i in prange(n0):
+        for ii in range(i*b0, min((i + 1)*b0, N0)):
+            for jj in range(min(n1*b1, N1)):
+                p_l, p_phi, p_th = p[0, ii, jj], p[1, ii, jj], p[2, ii, jj]
+                sin1 = np.sin(theta[ii, jj])
+                B_2 = p_th**2 + p_phi**2/(sin1*sin1)
+                j = jj//b1
+                B[0, i, j] += 0.5*(p_l**2 + B_2/r[ii, jj]**2)
+                B[1, i, j] += p_phi
+                B[2, i, j] += B_2
+
+Invariants_kernel = njit(Invariants_loop)
+Invariants_kernel_par = njit(parallel=True)(Invariants_loop)
+
+
+def blocks(Sh, Bs = None, Nb = None):
+    # input: Sh: shape of the rays (1D or 2D), Bs: block size along each axis,
+    #        Nb: amount of blocks along each axis
+    # output: Bs, Nb along both axes of the 2D kernels, by default int(sqrt(N))
+    #         blocks of int(sqrt(N)) rays, Nb = -(-N//Bs) also sums the remainder
+    Sh = tuple(Sh)
+    Bs = [int(np.sqrt(N)) for N in Sh] if Bs is None else list(np.broadcast_to(Bs, len(Sh)))
+    Nb = [int(np.sqrt(N)) for N in Sh] if Nb is None else list(np.broadcast_to(Nb, len(Sh)))
+    if len(Sh) == 1:
+        Bs, Nb = [1] + Bs, [1] + Nb
+    return int(Bs[0]), int(Bs[1]), int(Nb[0]), int(Nb[1])
+
+
+def sum_subd(A, Bs = None, Nb = None, stack = False, parallel = False):
+    # input: A: 1D/2D matrix, or with stack a list (k, ...) of them summed in one pass,
+    #        Bs, Nb: block size and amount of blocks along each axis (see blocks)
+    #        parallel: sum on all cores
+    # output: sum of A over each block, by default the matrix is split in
+    #         int(sqrt(N)) x int(sqrt(N)) blocks as before
+    A = np.asarray(A)
+    Sh = A.shape[1:] if stack else A.shape
+    b0, b1, n0, n1 = blocks(Sh, Bs, Nb)
+    A3 = A.reshape((-1,) + ((1,) + Sh if len(Sh) == 1 else Sh))
+    B = np.zeros((A3.shape[0], n0, n1))
+    kernel = Block_kernel_par if parallel else Block_kernel
+    kernel(A3, b0, b1, n0, n1, B)
+    if len(Sh) == 1:
+        B = B[:, 0]
+    return B if stack else B[0]
+
+
+def sum_invariants(p, theta, r, Bs = None, Nb = None, parallel = False):
+    # input: p: momenta (p_l, p_phi, p_th) of the rays, theta, r: their inclination and r(l),
+    #        Bs, Nb: see blocks, parallel: sum on all cores
+    # output: [H, b, B^2] summed over the blocks of the rays in one pass
+    r = np.asarray(r)
+    Sh = r.shape
+    b0, b1, n0, n1 = blocks(Sh, Bs, Nb)
+    Sh2 = (1, Sh[0]) if len(Sh) == 1 else Sh
+    B = np.zeros((3, n0, n1))
+    kernel = Invariants_kernel_par if parallel else Invariants_kernel
+    kernel(np.asarray(p).reshape((3,) + Sh2), np.asarray(theta).reshape(Sh2), r.reshape(Sh2),
+           b0, b1, n0, n1, B)
+    H, b, B_2 = B if len(Sh) == 2 else B[:, 0]
+    return [H, b, B_2]
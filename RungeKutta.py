@@ -1,47 +1,9 @@
 
 import numpy as np
+import Symplectic_DNeg as Smpl
+import Reduction as Red
 
-def dneg_r(l, M , rho, a):
-    # input: scalars
-    # output: scalar
-    # define r(l) for a DNeg wormhole without gravity
-
-    r = np.empty(l.shape)
-    l_abs = np.abs(l)
-    l_con = l_abs >= a
-    inv_l_con = ~l_con
-
-    x = 2*(l_abs[l_con] - a)/(np.pi*M)
-    r[l_con] = rho + M*(x*np.arctan2(2*(l_abs[l_con] - a), np.pi*M) - 0.5*np.log(1 + x**2))
-    r[inv_l_con] = rho
-    return r
-
-def dneg_dr_dl(l, M, a):
-    # input:scalars
-    # output: scalar
-    # define derivative of r to l
-
-    dr_dl = np.empty(l.shape)
-    l_abs = np.abs(l)
-    l_con = l_abs >= a
-    inv_l_con = ~l_con
-
-    x = 2*(l_abs[l_con] - a)/(np.pi*M)
-    dr_dl[l_con] = (2/np.pi)*np.arctan(x)*np.sign(l[l_con])
-    dr_dl[inv_l_con] = 0
-
-    return dr_dl
-
-def sum_subd(A):
-    # A 2D matrix such that the lengt of sides have int squares
-    Ny, Nz =  A.shape
-    Ny_s = int(np.sqrt(Ny))
-    Nz_s = int(np.sqrt(Nz))
-    B = np.zeros((Ny_s, Nz_s))
-    for i in range(Ny_s):
-        for j in range(Nz_s):
-            B[i,j] = np.sum(A[Ny_s*i:Ny_s*(i+1), Nz_s*j:Nz_s*(j+1)])
-    return B
+sum_subd = Red.sum_subd
 
 def runge_kutta(p, q, Cst, h, Par):
     """
@@ -49,12 +11,11 @@ def runge_kutta(p, q, Cst, h, Par):
             and the step length h.
     Output: [p, q] list of the updated momenta and position matrices after one step length h.
     """
-    M, rho, a = Par
     p_l, p_phi, p_th = p
     l, phi, theta = q
     b, B = Cst
 
-    r = dneg_r(l, M, rho, a)
+    r, dr, d2r = Smpl.Metric(l, Par)
     rec_r = 1/r
     rec_r_2 = rec_r**2
     rec_r_3 = rec_r_2*rec_r
@@ -62,18 +23,13 @@ def runge_kutta(p, q, Cst, h, Par):
     cos1 = np.cos(theta)
     sin2 = sin1**2
     sin3 = sin1*sin2
-    H1 = p_l**2
-    H2 = p_th**2*rec_r_2
-    H3 = p_phi**2/sin2*rec_r_2
-    H = 0.5*sum_subd((H1 + H2 + H3))
-    B2_C = sum_subd(p_th**2 + p_phi**2/sin2)
-    b_C = sum_subd(p_phi)
+    H, b_C, B2_C = Red.sum_invariants(p, theta, r)
 
     #Using the hamiltonian equations of motion
     dl_dt       = p_l
     dtheta_dt   = p_th * rec_r_2
     dphi_dt     = b / sin2 * rec_r_2
-    dpl_dt      = B**2 * (dneg_dr_dl(l, M, a)) * rec_r_3
+    dpl_dt      = B**2 * dr * rec_r_3
     dpth_dt     = b ** 2 * cos1 / sin3 * rec_r_2
 
     #defines k1
@@ -88,11 +44,11 @@ def runge_kutta(p, q, Cst, h, Par):
     # print(l)
 
     #Defining k2
-    r = dneg_r(l, M, rho, a)
+    r, dr, d2r = Smpl.Metric(l, Par)
     dl_dt       = p_l
     dtheta_dt   = p_th / r**2
     dphi_dt     = b / (r**2 * np.sin(theta)**2)
-    dpl_dt      = B**2 * (dneg_dr_dl(l, M, a)) / r**3
+    dpl_dt      = B**2 * dr / r**3
     dpth_dt     = b ** 2 * np.cos(theta) / (r ** 2 * np.sin(theta)**3)
 
     k2 = [dl_dt, dphi_dt, dtheta_dt, dpl_dt, np.zeros(dl_dt.shape), dpth_dt]
@@ -104,11 +60,11 @@ def runge_kutta(p, q, Cst, h, Par):
     p_th = p_th + h * k2[4] / 2
 
     # Defining k3
-    r = dneg_r(l, M, rho, a)
+    r, dr, d2r = Smpl.Metric(l, Par)
     dl_dt       = p_l
     dtheta_dt   = p_th / r**2
     dphi_dt     = b / (r**2 * np.sin(theta)**2)
-    dpl_dt      = B**2 * (dneg_dr_dl(l, M, a)) / r**3
+    dpl_dt      = B**2 * dr / r**3
     dpth_dt     = b ** 2 * np.cos(theta) / (r ** 2 * np.sin(theta)**3)
 
     k3 = [dl_dt, dphi_dt,dtheta_dt, dpl_dt, np.zeros(dl_dt.shape),  dpth_dt]
@@ -121,11 +77,11 @@ def runge_kutta(p, q, Cst, h, Par):
     p_th = p_th + h * k3[4]
 
     #Defining k4
-    r = dneg_r(l, M, rho, a)
+    r, dr, d2r = Smpl.Metric(l, Par)
     dl_dt       = p_l
     dtheta_dt   = p_th / r**2
     dphi_dt     = b / (r**2 * np.sin(theta)**2)
-    dpl_dt      = B**2 * (dneg_dr_dl(l, M, a)) / r**3
+    dpl_dt      = B**2 * dr / r**3
     dpth_dt     = b ** 2 * np.cos(theta) / (r ** 2 * np.sin(theta)**3)
 
     k4 = [dl_dt, dphi_dt, dtheta_dt, dpl_dt, np.zeros(dl_dt.shape), dpth_dt]
@@ -134,4 +90,168 @@ def runge_kutta(p, q, Cst, h, Par):
     p = p + np.multiply(k1[3:],(h/6)) + np.multiply(k2[3:],(h/3)) + np.multiply(k3[3:],(h/3)) + np.multiply(k4[3:],(h/6))
     q = q + np.multiply(k1[:3],(h/6)) + np.multiply(k2[:3],(h/3)) + np.multiply(k3[:3],(h/3)) + np.multiply(k4[:3],(h/6))
 
-    return [p, q, [H, b_C, B2_C]]
\ No newline at end of file
+    return [p, q, [H, b_C, B2_C]]
+
+# Dormand-Prince 5(4) tableau with the dense output of solve_ivp's RK45
+DP_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+DP_A = np.array([
+    [0, 0, 0, 0, 0],
+    [1/5, 0, 0, 0, 0],
+    [3/40, 9/40, 0, 0, 0],
+    [44/45, -56/15, 32/9, 0, 0],
+    [19372/6561, -25360/2187, 64448/6561, -212/729, 0],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]])
+DP_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+DP_E = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+DP_P = np.array([
+    [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+    [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+    [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+    [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+    [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+
+def rms(x):
+    # root mean square over the variables (first axis) of each ray
+    return np.sqrt(np.mean(x**2, axis=0))
+
+
+def dopri45_batch(f, t_span, y0, rtol = 1e-3, atol = 1e-6, t_eval = None, args = (), escape = None):
+    """
+    Adaptive Dormand-Prince 5(4) integrator (the RK45 method of solve_ivp) that
+    advances a whole batch of independent rays as arrays. Every ray has its own
+    step size and error control, rays that reached the end of t_span are masked out.
+    Input:  - f: f(t, y, *args) -> dy/dt, vectorised over the rays, with
+              t: times of the rays, y: (n, N_active) state of the rays
+            - t_span: [t0, t1], integration may run backwards
+            - y0: (n, N) initial values, the rays on the second axis
+            - rtol, atol: relative and absolute tolerance as in solve_ivp
+            - t_eval: sorted times (in the direction of integration) to store the
+              solution at, evaluated with the dense output
+            - escape: optional pair (stop_f, freeze_f), stop_f(y, *args) marks rays
+              that can leave the working set, freeze_f(y, T, *args) advances them
+              analytically by T for the remaining t_eval points and the endpoint
+    Output: - Y: (n, N) solution at t1, or (n, N, len(t_eval)) at t_eval, nan
+              for rays that were given up (see success)
+            - nfev: amount of function evaluations of each ray
+            - success: False for rays whose step size fell below the smallest
+              step at their time or whose error turned nan
+    """
+    t0, t1 = float(t_span[0]), float(t_span[1])
+    direction = 1. if t1 >= t0 else -1.
+    y = np.array(y0, dtype=np.float64)
+    n, N = y.shape
+    t = np.full(N, t0)
+    nfev = np.ones(N, dtype=int)
+    interval = abs(t1 - t0)
+    if t_eval is not None:
+        t_eval = np.asarray(t_eval, dtype=np.float64)
+        Y = np.full((n, N, len(t_eval)), np.nan)
+        k_next = np.zeros(N, dtype=int)
+    else:
+        Y = None
+
+    # initial step size of each ray, as select_initial_step in solve_ivp
+    f_cur = f(t, y, *args)
+    scale = atol + np.abs(y)*rtol
+    d0 = rms(y/scale)
+    d1 = rms(f_cur/scale)
+    small = (d0 < 1e-5) | (d1 < 1e-5)
+    h0 = np.where(small, 1e-6, 0.01*d0/np.where(small, 1, d1))
+    h0 = np.minimum(h0, interval)
+    f1 = f(t + h0*direction, y + h0*direction*f_cur, *args)
+    nfev += 1
+    d2 = rms((f1 - f_cur)/scale)/h0
+    d12 = np.maximum(d1, d2)
+    flat = d12 <= 1e-15
+    h1 = np.where(flat, np.maximum(1e-6, h0*1e-3), (0.01/np.where(flat, 1, d12))**(1/5))
+    h_abs = np.minimum(np.minimum(100*h0, h1), interval)
+
+    rejected = np.zeros(N, dtype=bool)
+    success = np.ones(N, dtype=bool)
+    active = np.arange(N) if interval > 0 else np.arange(0)
+    while active.size > 0:
+        ya = y[:, active]
+        ta = t[active]
+        min_step = 10*np.abs(np.nextafter(ta, direction*np.inf) - ta)
+        ha = np.maximum(h_abs[active], min_step)
+        t_new = ta + direction*ha
+        beyond = direction*(t_new - t1) > 0
+        t_new[beyond] = t1
+        h = t_new - ta
+        ha = np.abs(h)
+
+        # stages, K[0] is the derivative at the start of the step (FSAL)
+        K = np.empty((7, n, active.size))
+        K[0] = f_cur[:, active]
+        for s in range(1, 6):
+            dy = np.tensordot(DP_A[s, :s], K[:s], axes=(0, 0))*h
+            K[s] = f(ta + DP_C[s]*h, ya + dy, *args)
+        y_new = ya + h*np.tensordot(DP_B, K[:6], axes=(0, 0))
+        K[6] = f(t_new, y_new, *args)
+        nfev[active] += 6
+
+        # error control of each ray
+        scale = atol + np.maximum(np.abs(ya), np.abs(y_new))*rtol
+        err = rms(h*np.tensordot(DP_E, K, axes=(0, 0))/scale)
+        accept = err < 1
+        with np.errstate(divide='ignore'):
+            factor = 0.9*err**(-1/5)
+        factor = np.where(accept,
+                          np.where(err == 0, 10, np.minimum(10, factor)),
+                          np.maximum(0.2, factor))
+        factor[accept & rejected[active]] = np.minimum(1, factor[accept & rejected[active]])
+        h_abs[active] = ha*factor
+        rejected[active] = ~accept
+
+        # dense output on the t_eval points passed by the accepted steps
+        if Y is not None:
+            ia = np.nonzero(accept)[0]
+            while ia.size > 0:
+                k = k_next[active[ia]]
+                has = k < len(t_eval)
+                te = t_eval[np.minimum(k, len(t_eval) - 1)]
+                has &= direction*(te - t_new[ia]) <= 0
+                ia, te, k = ia[has], te[has], k[has]
+                if ia.size == 0:
+                    break
+                x = (te - ta[ia])/h[ia]
+                Q = np.tensordot(DP_P.T, K[:, :, ia], axes=(1, 0))
+                Y[:, active[ia], k] = ya[:, ia] + h[ia]*(x*(Q[0] + x*(Q[1] + x*(Q[2] + x*Q[3]))))
+                k_next[active[ia]] += 1
+
+        acc = active[accept]
+        y[:, acc] = y_new[:, accept]
+        t[acc] = t_new[accept]
+        f_cur[:, acc] = K[6][:, accept]
+
+        # rays at t1 are done, rays whose step fell below the minimum (or
+        # turned nan) are given up, their endpoint and later t_eval points stay nan
+        done = accept & (t_new == t1)
+        failed = ~accept & ~(h_abs[active] >= min_step)
+        y[:, active[failed]] = np.nan
+        success[active[failed]] = False
+        done |= failed
+
+        # escaped rays are finished analytically and removed from the working set
+        if escape is not None:
+            stop = np.zeros(active.size, dtype=bool)
+            stop[accept] = escape[0](y_new[:, accept], *args)
+            stop &= ~done
+            i_s = active[stop]
+            if i_s.size > 0:
+                y_s, t_s = y[:, i_s], t[i_s]
+                if Y is not None:
+                    for k in range(np.min(k_next[i_s]), len(t_eval)):
+                        sel = k_next[i_s] <= k
+                        Y[:, i_s[sel], k] = escape[1](y_s[:, sel], direction*(t_eval[k] - t_s[sel]), *args)
+                y[:, i_s] = escape[1](y_s, direction*(t1 - t_s), *args)
+                t[i_s] = t1
+            done |= stop
+        active = active[~done]
+
+    if Y is None:
+        Y = y
+    return Y, nfev, success
@@ -0,0 +1,13 @@
+import os
+
+
+def atomic_save(path, save, *args, **kwargs):
+    # input: path: file to write, save: function writing to an open file
+    #        (np.save, np.savez), args, kwargs: passed on to save
+    # the file is written to a temporary name first and then renamed, so a job
+    # killed while writing leaves the previous file intact and readers never
+    # see a partial file
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        save(f, *args, **kwargs)
+    os.replace(tmp, path)
@@ -1,26 +1,10 @@
 import numpy as np
-from numba import njit
+from numba import njit, prange
 import time
+import Reduction as Red
+
+sum_subd = Red.sum_subd
 
-def sum_subd(A):
-    # A 2D/1D matrix such that the lengt of sides have int squares
-    Sh = A.shape
-    if len(Sh) > 1:
-        Ny, Nz =  Sh
-        Ny_s = int(np.sqrt(Ny))
-        Nz_s = int(np.sqrt(Nz))
-        B = np.zeros((Ny_s, Nz_s))
-        for i in range(Ny_s):
-            for j in range(Nz_s):
-                B[i,j] = np.sum(A[Ny_s*i:Ny_s*(i+1), Nz_s*j:Nz_s*(j+1)])
-    else:
-        N = Sh
-        N_s = int(np.sqrt(N))
-        B = np.zeros(N_s)
-        for i in range(N_s):
-            B[i] = np.sum(A[N_s*i:N_s*(i+1)])
-    return B
-    
 
 @njit
 def Sympl_calc(P, Q, p, q, l, r, dr, d2r, Cst, h_vect, S):
@@ -99,34 +83,277 @@ def Sympl_calc(P, Q, p, q, l, r, dr, d2r, Cst, h_vect, S):
     return P, Q, b, B_2, H
 
 @njit
-def Dneg_r_Br(l, l_abs, M, rho, a):  
-    x = 2*(l_abs - a)/(np.pi*M)
-    x_tan = np.arctan(x)
-    r = rho + M*(x*x_tan - 0.5*np.log(1 + x**2))
-    dr = 2/np.pi*x_tan*np.sign(l)
-    d2r = (4*M)/(4*a**2 + M**2*np.pi**2 + 4*l**2 - 8*a*l_abs) 
+def Sympl_ray(p_l, p_phi, p_th, l, phi, theta, r, dr, d2r, h):
+    # input: momenta and position of one ray, r(l) and its derivatives, stepsize h
+    # output: p_l, p_th, l, phi, theta after one step, H and B_2 before the step,
+    #         same Taylor coefficients as Sympl_calc evaluated with Horner's rule,
+    #         err: largest third order Taylor term, estimate of the local error
+    #              (higher order terms vanish for whole families of rays, such as
+    #              rays in the equatorial plane, so they can't serve as estimate)
+    rec_r = 1/r
+    rec_r_2 = rec_r**2
+    rec_r_3 = rec_r_2*rec_r
+
+    sin1 = np.sin(theta)
+    sin2 = sin1**2
+    rec_sin1 = 1/sin1
+    cos1 = np.cos(theta)
+    rec_sin2 = rec_sin1**2
+    rec_sin3 = rec_sin1*rec_sin2
+
+    dr_2 = dr**2
+    c = 0.5*r*d2r - 1.5*dr_2
+    d = dr*rec_r
+    w = p_l*d
+    e = 0.5*p_l*np.sin(2*theta)*r*dr
+    g = 2*sin2 - 3
+    f = -p_th*g
+
+    H = 0.5*(p_l**2 + p_th**2*rec_r_2 + p_phi**2*rec_sin2*rec_r_2)
+    b = p_phi
+    B_2 = p_th**2 + p_phi**2*rec_sin2
+
+    Q01 = p_l
+    Q11 = b*rec_sin2*rec_r_2
+    Q21 = p_th*rec_r_2
+
+    P01 = B_2*dr*rec_r_3
+    P21 = b**2*cos1*rec_sin3*rec_r_2
+
+    m = Q21*cos1*rec_sin1
+    phi1_2 = Q11**2
+    y = p_th*w
+
+    Q02 = 0.5*P01
+    Q12 = -Q11*(w + m)
+    Q22 = (0.5*P21 - y)*rec_r_2
+
+    P02 = p_l*rec_r_2**2*B_2*c
+    P22 = -phi1_2*(e + f)
+
+    Q03 = 0.5*P02
+    Q13 = 2*Q11*Q21*m*w
+    Q23 = -phi1_2*rec_r_2*(e + 0.5*f)
+
+    s = phi1_2*g
+    o = 0.5*s*Q21
+
+    P03 = o*d
+    P23 = -s*y
+
+    Q04 = 0.5*P03
+    Q24 = 0.75*P23*rec_r_2
+
+    P04 = p_l*o*Q21*(c - 2*dr_2)
+
+    Q05 = 0.5*P04
+
+    err = h**3*max(abs(P03), abs(P23), abs(Q03), abs(Q13), abs(Q23))
+
+    p_l = p_l + h*(P01 + h*(P02 + h*(P03 + h*P04)))
+    p_th = p_th + h*(P21 + h*(P22 + h*P23))
+    l = l + h*(Q01 + h*(Q02 + h*(Q03 + h*(Q04 + h*Q05))))
+    phi = np.mod(phi + h*(Q11 + h*(Q12 + h*Q13)), 2*np.pi)
+    theta = np.mod(theta + h*(Q21 + h*(Q22 + h*(Q23 + h*Q24))), np.pi)
+    return p_l, p_th, l, phi, theta, H, B_2, err
+
+def Horner_loop(p, q, r, dr, d2r, h, CM):
+    # input: p, q: (3, N) matrices with the rays on the second axis, updated in place,
+    #        r, dr, d2r: r(l) and its derivatives for each ray,
+    #        h: stepsize, CM: (3, N) buffer that receives H, b and B_2 of each ray
+    for i in prange(p.shape[1]):
+        p_phi = p[1,i]
+        p_l, p_th, l, phi, theta, H, B_2, err = Sympl_ray(
+            p[0,i], p_phi, p[2,i], q[0,i], q[1,i], q[2,i], r[i], dr[i], d2r[i], h)
+        p[0,i] = p_l
+        p[2,i] = p_th
+        q[0,i] = l
+        q[1,i] = phi
+        q[2,i] = theta
+        CM[0,i] = H
+        CM[1,i] = p_phi
+        CM[2,i] = B_2
+
+# rays are independent, the parallel kernels give the same output as the serial ones
+Sympl_Horner = njit(Horner_loop)
+Sympl_Horner_par = njit(parallel=True)(Horner_loop)
+
+@njit
+def DNeg_r_ray(l, Met):
+    # input: l: scalar, Met: (M, rho, a)
+    # output: r(l), dr/dl and d2r/dl2 of the DNeg wormhole
+    M, rho, a = Met
+    l_abs = abs(l)
+    if l_abs >= a:
+        x = 2/(np.pi*M)*(l_abs - a)
+        x_tan = np.arctan(x)
+        return (rho + M*(x*x_tan - 0.5*np.log(1 + x**2)),
+                2/np.pi*x_tan*np.sign(l),
+                M/((l_abs - a)**2 + (0.5*M*np.pi)**2))
+    return rho, 0., 0.
+
+def DNeg_r_loop(l, M, rho, a, r, dr, d2r):
+    # input: l: 1D array of l coordinates, M, rho, a: scalars,
+    #        r, dr, d2r: preallocated 1D arrays with the same length as l
+    # fills r(l), dr/dl and d2r/dl2 of the DNeg wormhole in a single pass
+    for i in prange(l.size):
+        r[i], dr[i], d2r[i] = DNeg_r_ray(l[i], (M, rho, a))
+
+DNeg_r_kernel = njit(DNeg_r_loop)
+DNeg_r_kernel_par = njit(parallel=True)(DNeg_r_loop)
+
+
+def DNeg_metric(l, Par, r = None, dr = None, d2r = None, parallel = False):
+    # input: l: array (or scalar) of l coordinates, Par: [M, rho, a],
+    #        r, dr, d2r: optional preallocated C-contiguous float64 buffers
+    #        with the shape of l, filled in place
+    #        parallel: evaluate on all cores
+    # output: r(l), dr/dl, d2r/dl2
+    M, rho, a = Par
+    l = np.asarray(l, dtype=np.float64)
+    if r is None:
+        r = np.empty(l.shape)
+    if dr is None:
+        dr = np.empty(l.shape)
+    if d2r is None:
+        d2r = np.empty(l.shape)
+    kernel = DNeg_r_kernel_par if parallel else DNeg_r_kernel
+    kernel(l.reshape(-1), float(M), float(rho), float(a),
+           r.reshape(-1), dr.reshape(-1), d2r.reshape(-1))
     return r, dr, d2r
 
-def Sympl_DNeg(p, q, Cst, h_vect, Par, P, Q, r, dr, d2r, S):
+def Metric_ray(Par):
+    # input: Par: [M, rho, a] or a tabulated profile
+    # output: (f, Met): compiled function f(l, Met) -> r, dr, d2r for a single ray
+    #         and its arguments, for use inside other kernels
+    if callable(Par):
+        return Par.ray_f, Par.ray_args
+    M, rho, a = Par
+    return DNeg_r_ray, (float(M), float(rho), float(a))
+
+def Metric(l, Par, r = None, dr = None, d2r = None, parallel = False):
+    # input: l: array of l coordinates, Par: [M, rho, a] of a DNeg wormhole or
+    #        a tabulated profile (see Metric_Profile) that fills the buffers itself
+    # output: r(l), dr/dl, d2r/dl2
+    if callable(Par):
+        return Par(l, r, dr, d2r, parallel)
+    return DNeg_metric(l, Par, r, dr, d2r, parallel)
+
+def Sympl_DNeg(p, q, Cst, h_vect, Par, P, Q, r, dr, d2r, S, parallel = False, CM = True):
     # input: p: matrix with coordinates in momentum space on first row,
     # q: matrix with coordinates in configuration space on first row,
     # Cst: list of cst of motion containing the value for each ray in 2D matrix,
     # h: stepsize, M: scalar, rho: scalar, output: list of coordinates in
     # configuration space containing 2D matrix with value for each ray
+    # When Q is None p and q are C-contiguous and are stepped in place with
+    # Horner's rule, P is then a buffer shaped like p that receives H, b, B_2
+    # CM: sum H, b, B_2 over the blocks of the rays (see sum_subd), else None
+    # is returned in their place
     start = time.time()
-    M, rho, a = Par
-    
     l = q[0]
-    l_abs = np.abs(l)
-    l_con = l_abs >= a
-    inv_l_con = ~l_con
-    
-    r[l_con], dr[l_con], d2r[l_con] =  Dneg_r_Br(l[l_con], l_abs[l_con], M, rho, a)
-    r[inv_l_con] = rho
-    dr[inv_l_con] = 0
-    d2r[inv_l_con] = 0
+    Metric(l, Par, r, dr, d2r, parallel)
     
-    P, Q, b, B_2, H = Sympl_calc(P, Q, p, q, l, r, dr, d2r, Cst, h_vect, S)
+    if Q is None:
+        Horner = Sympl_Horner_par if parallel else Sympl_Horner
+        Horner(p.reshape(3, -1), q.reshape(3, -1), r.reshape(-1), dr.reshape(-1),
+                     d2r.reshape(-1), float(h_vect.flat[1]), P.reshape(3, -1))
+        Buf, P, Q = P, p, q
+    else:
+        P, Q, b, B_2, H = Sympl_calc(P, Q, p, q, l, r, dr, d2r, Cst, h_vect, S)
+        Buf = None
+    end = time.time()
+    if CM == False:
+        CM = None
+    elif Buf is None:
+        CM = [sum_subd(H), sum_subd(b), sum_subd(B_2)]
+    else:
+        # H, b, B_2 are the rows of the buffer, summed in one pass
+        CM = list(sum_subd(Buf, stack=True, parallel=parallel))
+    return (P, Q, CM, end-start)
+
+def Sympl_DNeg_par(p, q, Cst, h_vect, Par, P, Q, r, dr, d2r, S, CM = True):
+    # Sympl_DNeg with the metric and the in place Horner step spread over all
+    # cores (numba.set_num_threads), use with Simulate_DNeg(..., inplace = True)
+    return Sympl_DNeg(p, q, Cst, h_vect, Par, P, Q, r, dr, d2r, S, True, CM)
+
+
+def Adaptive_loop(p, q, t, h, t_target, tol, eta, metric_f, Met, nstep, n_max):
+    # input: p, q: (3, N) matrices with the rays on the second axis, updated in place,
+    #        t, h: time and current stepsize of each ray, updated in place,
+    #        t_target: time every ray is advanced to, tol: tolerance on the local error,
+    #        eta: largest fraction of r(l) a ray travels in one step,
+    #        metric_f, Met: see Metric_ray,
+    #        nstep: amount of steps taken by each ray, updated in place,
+    #        n_max: largest amount of steps (tried) per ray in one call
+    # every ray takes its own steps: h grows far from the throat and shrinks where
+    # the error estimate of Sympl_ray exceeds tol, rejected steps are retried.
+    # The estimate is taken at the start of a step, eta keeps a ray from stepping
+    # over the throat from a region where the estimate vanishes (|l| < a).
+    # Steps are never shorter than 1e-12*max(1, |t|), so every ray makes progress,
+    # a ray whose error or speed is no longer finite, or that needs more than
+    # n_max steps, is stopped and gets t = nan
+    for i in prange(p.shape[1]):
+        p_l, p_phi, p_th = p[0,i], p[1,i], p[2,i]
+        l, phi, theta = q[0,i], q[1,i], q[2,i]
+        t_i = t[i]
+        h_i = h[i]
+        n_i = 0
+        while t_i < t_target:
+            n_i += 1
+            if n_i > n_max:
+                t_i = np.nan
+                break
+            r, dr, d2r = metric_f(l, Met)
+            v = np.sqrt(p_l**2 + (p_th**2 + (p_phi/np.sin(theta))**2)/r**2)
+            h_min = 1e-12*max(1., abs(t_i))
+            h_s = max(min(h_i, eta*r/v), h_min)
+            last = h_s >= t_target - t_i
+            if last:
+                h_s = t_target - t_i
+            Res = Sympl_ray(p_l, p_phi, p_th, l, phi, theta, r, dr, d2r, h_s)
+            err = Res[7]
+            if not (np.isfinite(err) and np.isfinite(v)):
+                t_i = np.nan
+                break
+            if err == 0:
+                factor = 5.
+            else:
+                factor = min(5., max(0.2, 0.9*(tol/err)**(1/3)))
+            if err <= tol or h_s <= h_min:
+                p_l, p_th, l, phi, theta = Res[0], Res[1], Res[2], Res[3], Res[4]
+                # the last step lands on t_target exactly
+                t_i = t_target if last else t_i + h_s
+                nstep[i] += 1
+                # a step shortened to land on t_target says nothing about larger steps
+                if h_s < h_i:
+                    factor = min(factor, 1.)
+                h_i = max(h_i*factor, h_s*factor)
+            else:
+                h_i = h_s*factor
+        p[0,i], p[2,i] = p_l, p_th
+        q[0,i], q[1,i], q[2,i] = l, phi, theta
+        t[i] = t_i
+        h[i] = h_i
+
+Sympl_adaptive = njit(Adaptive_loop)
+Sympl_adaptive_par = njit(parallel=True)(Adaptive_loop)
+
+
+def Sympl_DNeg_adaptive(p, q, t, h, t_target, tol, Par, nstep, eta = 0.1, parallel = False, n_max = 10**7):
+    # input: p, q: C-contiguous matrices with the coordinates on the first row,
+    #        t, h, nstep: arrays with the time, stepsize and amount of steps of each ray,
+    #        t_target: time to advance all rays to, tol: tolerance on the local error,
+    #        Par: [M, rho, a] or a tabulated profile,
+    #        eta: largest fraction of r(l) a ray travels in one step,
+    #        parallel: spread the rays over all cores,
+    #        n_max: largest amount of steps per ray in one call
+    # output: p, q advanced in place to t_target, time spent, rays whose error
+    #         estimate is no longer finite or that need more than n_max steps
+    #         stay where they stopped with t = nan
+    start = time.time()
+    metric_f, Met = Metric_ray(Par)
+    kernel = Sympl_adaptive_par if parallel else Sympl_adaptive
+    kernel(p.reshape(3, -1), q.reshape(3, -1), t.reshape(-1), h.reshape(-1),
+           float(t_target), float(tol), float(eta), metric_f, Met, nstep.reshape(-1), int(n_max))
     end = time.time()
-    return (P, Q, [sum_subd(H), sum_subd(b), sum_subd(B_2)], end-start) 
-    
\ No newline at end of file
+    return p, q, end-start
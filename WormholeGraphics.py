@@ -4,82 +4,168 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import numpy as np
 import InbeddingDiagramDNeg as Dia
+import Symplectic_DNeg as Smpl
 import os
+from numba import njit, prange
+
+# BGR colours of the schemes of Pict_loop, Make_Pict_RB: l <= 0, l > 0
+Colors_RB = np.array([[255, 0, 0], [0, 0, 255]], dtype=np.uint8)
+# Make_Pict_RGBP: grid, the four quadrants of (phi, theta) and rays on a
+# boundary, followed by the same colours inverted for l < 0
+Quadrants = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1], [0.5, 0.5, 0], [0, 0, 0]])
+Colors_RGBP = np.round(255*np.concatenate(([[0, 0, 0]], Quadrants, 1 - Quadrants))).astype(np.uint8)
+
+
+def Pict_loop(l, phi, theta, Grid, Colors, scheme, out):
+    # input: l, phi, theta: 1D arrays with the endpoints of the rays,
+    #        Grid: 1D boolean array of rays on the grid (only used by scheme 1),
+    #        Colors: BGR table of the scheme, scheme: 0 = sign of l, 1 = quadrants,
+    #        out: (N, 3) uint8 buffer the picture is written in
+    for i in prange(l.size):
+        if scheme == 0:
+            c = 0 if l[i] <= 0 else 1
+        elif Grid[i]:
+            c = 0
+        else:
+            if phi[i] > np.pi and theta[i] > np.pi/2:
+                c = 1
+            elif phi[i] > np.pi and theta[i] < np.pi/2:
+                c = 2
+            elif phi[i] < np.pi and theta[i] > np.pi/2:
+                c = 3
+            elif phi[i] < np.pi and theta[i] < np.pi/2:
+                c = 4
+            else:
+                c = 5
+            # invert color for points on oposite side of wormhole
+            if l[i] < 0:
+                c += 5
+        out[i, 0] = Colors[c, 0]
+        out[i, 1] = Colors[c, 1]
+        out[i, 2] = Colors[c, 2]
+
+Pict_kernel = njit(Pict_loop)
+Pict_kernel_par = njit(parallel=True)(Pict_loop)
+
+
+def Make_Pict(q, Grid = None, scheme = 'RGBP', out = None, parallel = False):
+    # input: q: matrix with coordinates in configuration space on first row, q = (l, phi, theta)
+    #        Grid: boolean matrix of rays on the grid, for scheme 'RGBP',
+    #              by default no ray is on the grid
+    #        scheme: 'RB' colours on sign(l), 'RGBP' on the quadrant of (phi, theta)
+    #        out: optional (Nz, Ny, 3) uint8 frame that is written in place
+    #        parallel: colour the rays on all cores
+    # output: 3D uint8 matrix (2D matrix of rays each containing a BGR color)
+    Nz, Ny = q[0].shape
+    if out is None:
+        out = np.empty((Nz, Ny, 3), dtype=np.uint8)
+    elif out.shape != (Nz, Ny, 3) or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise ValueError('out should be a C-contiguous uint8 array of shape ' + str((Nz, Ny, 3)))
+    l, phi, theta = (np.ascontiguousarray(c).reshape(-1) for c in q)
+
+    if scheme == 'RB':
+        Colors, k, Grid = Colors_RB, 0, np.zeros(1, dtype=bool)
+    elif scheme == 'RGBP':
+        if Grid is None:
+            Grid = np.zeros(l.size, dtype=bool)
+        Colors, k, Grid = Colors_RGBP, 1, np.ascontiguousarray(Grid, dtype=bool).reshape(-1)
+        # the kernel does not check bounds, every ray needs its own Grid entry
+        if Grid.size != l.size:
+            raise ValueError('Grid should have one element per ray, got ' + str(Grid.size) + ' for ' + str(l.size) + ' rays')
+    else:
+        raise ValueError('unknown color scheme: ' + str(scheme))
 
-def Make_Pict_RB(q):
+    kernel = Pict_kernel_par if parallel else Pict_kernel
+    kernel(l, phi, theta, Grid, Colors, k, out.reshape(-1, 3))
+    return out
+
+
+def Make_Pict_RB(q, out = None):
     # input: q: matrix with coordinates in configuration space on first row ouput:
     # 3D matrix (2D matrix of rays each containing a coordinate in colorspace)
-    # RGB based on sign(l), q = (l, phi, theta)
-    pict = []
-    for j in range(len(q[0])):
-        row = []
-        for i in range(len(q[0][0])):
-            if q[0][j,i] <= 0:
-                row.append([255, 0, 0])
-            else:
-                row.append([0, 0, 255])
-        pict.append(row)
-    return cv2.cvtColor(np.array(pict, np.float32), 1)
+    # BGR based on sign(l), q = (l, phi, theta), see Make_Pict
+    return Make_Pict(q, None, 'RB', out)
+
+
+@njit
+def near_line(x, n, top, tol):
+    # input: x: angle, n + 1: amount of grid lines evenly spaced on [0, top]
+    #        (as np.linspace(0, top, n + 1)), tol: half width of the lines
+    # output: True when x lies within tol of the nearest grid line
+    if not (x == x) or n < 0:
+        return False
+    if n == 0:
+        return abs(x) < tol
+    d = top/n
+    k = int(min(max(round(x/d), 0.), float(n)))
+    for kk in range(max(k - 1, 0), min(k + 1, n) + 1):
+        L = top if kk == n else kk*d
+        if abs(x - L) < tol:
+            return True
+    return False
+
+
+def Grid_hit_loop(r, phi, theta, N_a, R, w, Slice, shell):
+    # input: r, phi, theta: 1D arrays with the coordinates of the rays,
+    #        N_a, R, w: see Grid_constr_3D_Sph, Slice: 1D boolean array updated
+    #        in place, rays already on the grid are skipped,
+    #        shell: spherical grid (Grid_constr_3D_Sph) or polar grid (Grid_constr_2D)
+    tol_phi = 2*np.pi/N_a*w
+    tol_th = np.pi/N_a*w
+    for i in prange(r.size):
+        if Slice[i]:
+            continue
+        on_phi = near_line(phi[i], N_a - 2, 2*np.pi, tol_phi)
+        on_theta = near_line(theta[i], N_a - 2, np.pi, tol_th)
+        if shell:
+            # np.mod(r, R), only the shells just above r are tested (as before)
+            m = np.fmod(r[i], R)
+            if m != 0 and (m < 0) != (R < 0):
+                m += R
+            on_shell = abs(R - m) < R*w
+            Slice[i] = (on_phi and on_theta) or (on_phi and on_shell) or (on_shell and on_theta)
+        else:
+            Slice[i] = on_phi or on_theta
+
+Grid_hit = njit(Grid_hit_loop)
+Grid_hit_par = njit(parallel=True)(Grid_hit_loop)
 
 
-def Grid_constr_2D(q, N_a, R, w):
+def Grid_constr_2D(q, N_a, R, w, parallel = False):
     # input: q: matrix with coordinates in configuration space on first row
     #        N_a: subdivision angles
     #        N_r: linspace radius to form grid
     #        w: ratio
+    #        parallel: test the rays on all cores
     #output: 2D boolean array
     Nz, Ny =  q[0].shape
-    r, phi, theta = q
-
-    # subdivides theta and phi
-    Par_phi = np.linspace(0, 2*np.pi, N_a-1)
-    Par_th = np.linspace(0, np.pi, N_a-1)
-
-    # Defines point on polar grid
-    on_phi = np.any(
-        np.abs(phi.reshape(1,Nz,Ny) -
-               np.transpose(np.tile(Par_phi, (Nz, Ny,1)), (2,0,1)))
-        < 2*np.pi/N_a*w, axis=0)
-
-    on_theta = np.any(
-        np.abs(theta.reshape(1,Nz,Ny) -
-               np.transpose(np.tile(Par_th, (Nz, Ny,1)), (2,0,1)))
-        < np.pi/N_a*w,  axis=0)
+    r, phi, theta = (np.ascontiguousarray(c, dtype=np.float64).reshape(-1) for c in q)
+    Slice = np.zeros((Nz, Ny), dtype=bool)
 
-    return on_phi | on_theta
+    # rays on the polar grid of N_a - 1 subdivisions of theta and phi
+    kernel = Grid_hit_par if parallel else Grid_hit
+    kernel(r, phi, theta, N_a, float(R), float(w), Slice.reshape(-1), False)
+    return Slice
 
 
-def Grid_constr_3D_Sph(q, N_a, R, w, Slice = None):
+def Grid_constr_3D_Sph(q, N_a, R, w, Slice = None, parallel = False):
     # input: q: matrix with coordinates in configuration space on first row
     #        N_a: subdivision angles
     #        R: linspace radius to form grid
     #        w: ratio
+    #        Slice: rays already on the grid, updated in place when C-contiguous
+    #        parallel: test the rays on all cores
     #output: 2D boolean array
     Nz, Ny =  q[0].shape
     if np.any(Slice == None):
         Slice = np.zeros((Nz, Ny), dtype=bool)
-    Slice_inv = ~Slice
-    r, phi, theta = q
-
-    # subdivides theta and phi
-    Par_phi = np.linspace(0, 2*np.pi, N_a-1)
-    Par_th = np.linspace(0, np.pi, N_a-1)
-
-    # Defines point on spherical grid
-    rr = r[Slice_inv]
-    M = len(rr)
-    on_shell = (np.abs(R - np.mod(rr, R)) < R*w) | (np.abs(np.mod(rr, R) - R) < R*w)
-
-    on_phi = np.any(
-        np.abs(phi[Slice_inv].reshape(1,M) - np.tile(Par_phi, (M,1)).T)
-        < 2*np.pi/N_a*w, axis=0)
+    Slice = np.ascontiguousarray(Slice)
+    r, phi, theta = (np.ascontiguousarray(c, dtype=np.float64).reshape(-1) for c in q)
 
-    on_theta = np.any(
-        np.abs(theta[Slice_inv].reshape(1,M) - np.tile(Par_th, (M,1)).T)
-        < np.pi/N_a*w,  axis=0)
-
-    # Boolean conditions for when rays lands on spherical grid
-    Slice[Slice_inv] = (on_phi & on_theta) | (on_phi & on_shell) | (on_shell & on_theta)
+    # rays landing on the spherical grid: on two of the shells and the N_a - 1
+    # subdivisions of theta and phi, only rays not yet on the grid are tested
+    kernel = Grid_hit_par if parallel else Grid_hit
+    kernel(r, phi, theta, N_a, float(R), float(w), Slice.reshape(-1), True)
     return Slice
 
 
@@ -115,25 +201,11 @@ def Grid_constr_3D_Cart(q, N_a, R, w, Slice = None):
     return Slice
 
 
-def Make_Pict_RGBP(q, Grid):
+def Make_Pict_RGBP(q, Grid, out = None):
     # input: q: matrix with coordinates in configuration space on first row
     # output: 3D matrix (2D matrix of rays each containing a coordinate in colorspace)
-    Nz, Ny =  q[0].shape
-    pict = np.empty((Nz, Ny, 3))
-    Grid_inv = ~Grid
-    r, phi, theta = q
-    
-    pict[Grid] = np.array([0,0,0])
-    # colors based on sign azimutha angle and inclination
-    pict[((phi > np.pi) & (theta > np.pi/2)) & Grid_inv] = np.array([0, 1, 0])
-    pict[((phi > np.pi) & (theta < np.pi/2)) & Grid_inv] = np.array([1, 0, 0])
-    pict[((phi < np.pi) & (theta > np.pi/2)) & Grid_inv] = np.array([0, 0, 1])
-    pict[((phi < np.pi) & (theta < np.pi/2)) & Grid_inv] = np.array([0.5, 0.5, 0])
-    # invert color for points on oposite side of wormhole
-    pict[(r < 0) & Grid_inv] = 1 - pict[(r < 0) & Grid_inv]
-    
-    pict = cv2.cvtColor(np.array(pict, np.float32), 1)
-    return pict
+    # colors based on sign azimutha angle and inclination, see Make_Pict
+    return Make_Pict(q, Grid, 'RGBP', out)
 
 def plot_CM(CM, Label, name, path):
     #input: 3D array containing energy of each ray over time, advancement in time on first row
@@ -218,7 +290,9 @@ def ray_spread(Nz, Ny):
 
 
 def gdsc(Motion, Par, name, path, geo_label = None, select = None, reduce = False):
-    # input: Motion: 5D matrix, the elements being [p, q] with p, q as defined earlier
+    # input: Motion: 5D matrix, the elements being [p, q] with p, q as defined earlier,
+    #               may be memory mapped (see w.load_Motion), with select or reduce
+    #               only the plotted geodesics are read from disk
     #       Par: parameters wormhole
     #       Name: picture/filename
     #       Path: directory
@@ -252,7 +326,7 @@ def gdsc(Motion, Par, name, path, geo_label = None, select = None, reduce = Fals
     l, phi, theta = q
     # caluclates coordinates in inbedded space
     ax = plt.figure().add_subplot(projection='3d')
-    r = w.dneg_r(l, M, rho, a)
+    r = Smpl.Metric(l, Par)[0]
     X, Y = r*np.cos(phi), r*np.sin(phi)
     
     S_l = np.linspace(np.max(l), np.min(l), len(l))
@@ -285,7 +359,7 @@ def gdsc(Motion, Par, name, path, geo_label = None, select = None, reduce = Fals
 
     #S_l = np.linspace(np.max(l), np.min(l), len(l))
     S_phi = np.linspace(0, 2*np.pi, len(l))
-    S_R, S_PHI = np.meshgrid(w.dneg_r(S_l, M, rho, a), S_phi) # radius is r(l)
+    S_R, S_PHI = np.meshgrid(Smpl.Metric(S_l, Par)[0], S_phi) # radius is r(l)
 
     # tile because symmetric for rotations, undependant on phi
     # Integral for Z direction like defined in the paper
@@ -318,12 +392,14 @@ def fullplothalf(ax, q_cart, l_cond, cl, ind, L):
     ax.axis("off")
 
 def fullplot(q, a):
+    # input: q: positions over time (time, coordinate, Nz, Ny), may be a memory
+    #           mapped Motion[:, 1], only the sampled rays are read
+    #        a: plot every a-th ray in both directions
     q = np.transpose(q, (1,0,2,3))
-    print(q[0][q[0] < 0].shape, q[0].shape)
     Nz, Ny =  q[0,0].shape
 
     # Samples a uniform portion of the rays for visualisation
-    Sample = q[:, :, 1::a, 1::a]
+    Sample = np.array(q[:, :, 1::a, 1::a], dtype=np.float64)
     print(Sample[0][Sample[0] < 0].shape, Sample[0].shape)
     cl, ind = ray_spread(len(Sample[0,0]), len(Sample[0,0,0]))
     
@@ -364,7 +440,7 @@ def density_states_plot(pq_final, Par, H_max, n_bins, path, name):
     l, phi, theta = q
 
     # defining r(l):
-    r = w.dneg_r(l, M, rho, a)
+    r = Smpl.Metric(l, Par)[0]
 
     rec_r = 1/r
     rec_r_2 = rec_r**2
@@ -1,42 +1,149 @@
-from tqdm.auto import tqdm
 import cv2
 import numpy as np
+import os
+from collections import OrderedDict
 from math import floor
+import Storage as St
+
+
+# decoded celestial spheres, keyed by (path, mtime, dtype, pad), least recently used first
+TEXTURE_CACHE_SIZE = 8
+_Textures = OrderedDict()
+
+
+def pad_texture(img, pad = 1):
+    """
+    Adds a border to a celestial sphere picture so bilinear lookups need no
+    index wrapping: columns (phi) wrap around, rows (theta) repeat the edge.
+    Input:  - img: picture of the celestial sphere
+            - pad: width of the border in pixels
+    Output: - C-contiguous picture with shape (Nz + 2 pad, Ny + 2 pad, 3)
+    """
+    img = np.pad(img, ((0, 0), (pad, pad), (0, 0)), mode='wrap')
+    img = np.pad(img, ((pad, pad), (0, 0), (0, 0)), mode='edge')
+    return np.ascontiguousarray(img)
+
+
+def load_texture(path, dtype = np.uint8, pad = 1, sidecar = False):
+    """
+    Decodes a celestial sphere picture once and keeps it in an LRU cache, a
+    changed file (other mtime) is decoded again.
+    Input:  - path: picture file
+            - dtype: np.uint8 or np.float32
+            - pad: border added with pad_texture
+            - sidecar: store the padded picture next to the file as .npy and
+              memory map it, so worker processes share one copy
+    Output: - read-only padded picture, shared by every caller, remove the
+              border with [pad:-pad, pad:-pad]
+    """
+    path = os.path.abspath(path)
+    dtype = np.dtype(dtype)
+    key = (path, os.stat(path).st_mtime_ns, dtype.str, pad)
+    if key in _Textures:
+        _Textures.move_to_end(key)
+        return _Textures[key]
+
+    npy = f'{path}.{dtype.name}.pad{pad}.npy'
+    if sidecar and os.path.exists(npy) and os.stat(npy).st_mtime_ns >= key[1]:
+        tex = np.load(npy, mmap_mode='r')
+    else:
+        img = cv2.imread(path)
+        if img is None:
+            raise FileNotFoundError(f"could not read picture '{path}'")
+        tex = pad_texture(img.astype(dtype), pad)
+        if sidecar:
+            St.atomic_save(npy, np.save, tex)
+            tex = np.load(npy, mmap_mode='r')
+    # the cached picture is shared, drawing on it would change later frames
+    tex.flags.writeable = False
+
+    _Textures[key] = tex
+    while len(_Textures) > TEXTURE_CACHE_SIZE:
+        _Textures.popitem(last=False)
+    return tex
+
+
+def build_mipmaps(sky, pad = 0):
+    """
+    Mip pyramid of a celestial sphere picture, every level averages 2x2 pixels
+    of the previous one (odd sizes are first extended by wrapping in phi and
+    repeating the last row in theta).
+    Input:  - sky: picture of the celestial sphere, pad: its border (see pad_texture)
+    Output: - list of float32 pictures, level 0 is sky itself without border
+    """
+    if pad > 0:
+        sky = sky[pad:-pad, pad:-pad]
+    Mips = [np.ascontiguousarray(sky, dtype=np.float32)]
+    while min(Mips[-1].shape[:2]) > 1:
+        img = Mips[-1]
+        if img.shape[1] % 2:
+            img = np.concatenate((img, img[:, :1]), axis=1)
+        if img.shape[0] % 2:
+            img = np.concatenate((img, img[-1:]), axis=0)
+        Mips.append(0.25*(img[0::2, 0::2] + img[1::2, 0::2] + img[0::2, 1::2] + img[1::2, 1::2]))
+    return Mips
+
+
+def load_mipmaps(path):
+    """
+    Mip pyramid (build_mipmaps) of a picture, kept in the texture cache.
+    Input:  - path: picture file
+    Output: - list of read-only float32 pictures
+    """
+    path = os.path.abspath(path)
+    key = (path, os.stat(path).st_mtime_ns, 'mipmaps')
+    if key in _Textures:
+        _Textures.move_to_end(key)
+        return _Textures[key]
+    Mips = build_mipmaps(load_texture(path), pad=1)
+    for img in Mips:
+        img.flags.writeable = False
+    _Textures[key] = Mips
+    while len(_Textures) > TEXTURE_CACHE_SIZE:
+        _Textures.popitem(last=False)
+    return Mips
+
+
+def clear_texture_cache():
+    _Textures.clear()
 
 
 def read_pics(saturn, gargantua):
     
     print('Reading in pictures...')
-    img_saturn    = cv2.imread(saturn)
-    img_gargantua = cv2.imread(gargantua)
+    # copies, the cached pictures are read-only
+    img_saturn    = load_texture(saturn, pad=0).copy()
+    img_gargantua = load_texture(gargantua, pad=0).copy()
     
     return img_saturn, img_gargantua
     
 
 def photo_to_sphere(photo):
     """
-    Give the pixels of the pictures a spherical coordinate
+    Give the pixels of the pictures a spherical coordinate: the sphere is the
+    equirectangular picture itself, row i at theta = i pi/Nz and column j at
+    phi = 2 pi j/Ny, look up pixels with sphere_index
     Input:  - photo: de pixels van de photo in sferische coordinaten
-    Output: - dict: een dictionary met als sleutel (theta, phi) en als waarde
-              de RGB-value van de bijbehorende pixel
+    Output: - sphere: C-contiguous (Nz, Ny, 3) array with the RGB-values
     """
+    return np.ascontiguousarray(photo)
 
-    dict = {}
-    vertical   = len(photo)     #1024
-    horizontal = len(photo[0])  #2048
-    for row in range(0, vertical):
-        for column in range(0, horizontal):
-            theta = (np.pi/vertical) * row #- np.pi
-            phi   = (2*np.pi/horizontal) * column
-            while phi>2*np.pi:
-                phi = phi - 2*np.pi
-            while phi<0:
-                phi = phi + 2*np.pi
-            coordinate = (theta, phi) #Tuple with angles that will be used as key
-            pixel      = np.array([photo[row][column]]) #RGB-values
-            dict[coordinate] = pixel
 
-    return dict
+def sphere_index(sphere, theta, phi):
+    """
+    Row and column of the pixel of the sphere closest in theta and in phi,
+    the angles are not wrapped (as the nearest element of the lists of
+    angles of the pixels). An angle halfway between two pixels gets the
+    lower one, like the first match of a search through the ascending lists.
+    Input:  - sphere: sphere made by photo_to_sphere
+            - theta, phi: arrays with the angles of the rays
+    Output: - i, j: row and column of each ray
+    """
+    Nz, Ny = sphere.shape[:2]
+    # rounding half down, np.rint would round half to even
+    i = np.clip(np.ceil(Nz*np.asarray(theta)/np.pi - 0.5), 0, Nz - 1).astype(int)
+    j = np.clip(np.ceil(Ny*np.asarray(phi)/(2*np.pi) - 0.5), 0, Ny - 1).astype(int)
+    return i, j
 
 
 def determine_theta(Nz, theta):
@@ -61,61 +168,185 @@ def determine_phi(Ny, phi):
     return j
 
 
-def make_picture(photo, gargantua, saturn):
-    Nz = len(photo)
-    Ny = len(photo[0])
-    
-    pic = np.empty([Nz, Ny, 3])
-    for rij in tqdm(range(0, Nz)):
-        for kolom in range(0, Ny):
-            element = photo[rij][kolom]
-            l, phi, theta = element
-            loctheta = determine_theta(len(saturn), theta)
-            locphi = determine_phi(len(saturn[0]), phi)
-            if l < 0:
-                pic[rij][kolom] = gargantua[loctheta][locphi]
-            else:
-                pic[rij][kolom] = saturn[loctheta][locphi]
+def sample_sky(sky, phi, theta, filter = 'nearest', pad = 0):
+    """
+    Looks up the colour of a celestial sphere picture in the directions (phi, theta).
+    Input:  - sky: picture of the celestial sphere (rows theta 0 to pi, columns phi 0 to 2pi)
+            - phi, theta: arrays with the angles of the rays
+            - filter: 'nearest' takes the pixel the direction falls in (as
+              determine_theta and determine_phi), 'bilinear' interpolates between
+              the four nearest pixel centres, wrapping around in phi
+            - pad: border of sky (see pad_texture), with pad >= 1 the bilinear
+              lookups read the border instead of wrapping the indices
+    Output: - RGB: array with the colour of each ray on the last axis
+    """
+    Nz, Ny = sky.shape[0] - 2*pad, sky.shape[1] - 2*pad
+    u = Nz*np.asarray(theta)/np.pi
+    v = Ny*np.asarray(phi)/(2*np.pi)
+    if filter == 'nearest':
+        i = np.clip(np.floor(u).astype(int), 0, Nz - 1) + pad
+        j = np.mod(np.floor(v).astype(int), Ny) + pad
+        return sky[i, j]
+    elif filter == 'bilinear':
+        u = u - 0.5
+        v = v - 0.5
+        i0 = np.floor(u)
+        j0 = np.floor(v)
+        fu = (u - i0)[..., None].astype(np.float32)
+        fv = (v - j0)[..., None].astype(np.float32)
+        i0 = i0.astype(int)
+        j0 = j0.astype(int)
+        if pad == 0:
+            i = np.clip([i0, i0 + 1], 0, Nz - 1)
+            j = np.mod([j0, j0 + 1], Ny)
+        else:
+            i0 = np.clip(i0, -1, Nz - 1) + pad
+            j0 = np.mod(j0 + 1, Ny) - 1 + pad
+            i = [i0, i0 + 1]
+            j = [j0, j0 + 1]
+        top = (1 - fv)*sky[i[0], j[0]] + fv*sky[i[0], j[1]]
+        bottom = (1 - fv)*sky[i[1], j[0]] + fv*sky[i[1], j[1]]
+        return (1 - fu)*top + fu*bottom
+    else:
+        raise ValueError(f"unknown filter '{filter}', use 'nearest' or 'bilinear'")
+
+
+def ray_footprint(photo):
+    """
+    Angular size of the patch of sky each pixel sees, estimated from the exit
+    directions of the neighbouring pixels. Neighbours that end up on the other
+    side of the wormhole or have no endpoint (nan) are left out.
+    Input:  - photo: (Nz, Ny, 3) array with the l, phi, theta endpoint of each pixel
+    Output: - dpsi: (Nz, Ny) array with the largest angle [rad] to a neighbour
+    """
+    l, phi, theta = np.moveaxis(np.asarray(photo), -1, 0)
+    u = np.array([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), np.cos(theta)])
+    side = l < 0
+    dpsi = np.zeros(l.shape)
+    for axis in (1, 2):
+        d = np.linalg.norm(np.diff(u, axis=axis), axis=0)
+        d[np.diff(side, axis=axis-1)] = 0
+        d = 2*np.arcsin(np.minimum(d/2, 1))
+        lo = [slice(None)]*2
+        hi = [slice(None)]*2
+        lo[axis-1] = slice(None, -1)
+        hi[axis-1] = slice(1, None)
+        dpsi[tuple(lo)] = np.fmax(dpsi[tuple(lo)], d)
+        dpsi[tuple(hi)] = np.fmax(dpsi[tuple(hi)], d)
+    return dpsi
+
+
+def sample_sky_mip(Mips, phi, theta, dpsi):
+    """
+    Anti-aliased lookup in a mip pyramid: the level is chosen so one texel
+    covers the footprint dpsi of the ray, and the two nearest levels are
+    sampled bilinearly and blended (trilinear filtering).
+    Input:  - Mips: mip pyramid from build_mipmaps
+            - phi, theta: 1D arrays with the angles of the rays
+            - dpsi: footprint of each ray (ray_footprint)
+    Output: - RGB: array with the colour of each ray on the last axis
+    """
+    Nz, Ny = Mips[0].shape[:2]
+    sin_th = np.maximum(np.abs(np.sin(theta)), 1/Ny)
+    texels = dpsi*np.maximum(Nz/np.pi, Ny/(2*np.pi*sin_th))
+    lod = np.clip(np.log2(np.maximum(texels, 1)), 0, len(Mips) - 1)
+    k0 = np.floor(lod).astype(int)
+    f = (lod - k0)[:, None].astype(np.float32)
+
+    RGB = np.zeros(np.shape(phi) + Mips[0].shape[2:], dtype=np.float32)
+    for k in np.unique(k0):
+        Ind = k0 == k
+        RGB[Ind] = sample_sky(Mips[k], phi[Ind], theta[Ind], 'bilinear')
+        if k + 1 < len(Mips):
+            Blend = Ind & (f[:, 0] > 0)
+            RGB[Blend] += f[Blend]*(sample_sky(Mips[k+1], phi[Blend], theta[Blend], 'bilinear') - RGB[Blend])
+    return RGB
+
+
+def make_picture(photo, gargantua, saturn, filter = 'nearest', pad = 0):
+    """
+    Colours every pixel with the celestial sphere its ray ends up on.
+    Input:  - photo: (Nz, Ny, 3) array with the l, phi, theta endpoint of each pixel
+            - gargantua: picture seen for l < 0
+            - saturn: picture seen for l >= 0
+            - filter, pad: see sample_sky, 'trilinear' samples a mip pyramid
+              (sample_sky_mip) at the footprint of each pixel, gargantua and
+              saturn may then also be pyramids from build_mipmaps
+    Output: - pic: (Nz, Ny, 3) array with the colour of each pixel, black for
+              rays without an endpoint (nan, the integrator gave up on them)
+    """
+    l, phi, theta = np.moveaxis(np.asarray(photo), -1, 0)
+    Found = np.isfinite(l) & np.isfinite(phi) & np.isfinite(theta)
+    Neg = Found & (l < 0)
+    Pos = Found & (l >= 0)
+
+    pic = np.zeros(l.shape + (3,))
+    if filter == 'trilinear':
+        dpsi = ray_footprint(photo)
+        for Ind, sky in ((Neg, gargantua), (Pos, saturn)):
+            Mips = sky if isinstance(sky, list) else build_mipmaps(sky, pad)
+            pic[Ind] = sample_sky_mip(Mips, phi[Ind], theta[Ind], dpsi[Ind])
+        return pic
+    pic[Neg] = sample_sky(gargantua, phi[Neg], theta[Neg], filter, pad)
+    pic[Pos] = sample_sky(saturn, phi[Pos], theta[Pos], filter, pad)
     return pic
 
 
-def make_pic_quick(pic, sat, gar):
+def make_pic_quick(pic, sat, gar, filter = 'nearest', sidecar = False):
     
-    img_saturn, img_gargantua = read_pics(sat, gar)
+    print('Reading in pictures...')
+    if filter == 'trilinear':
+        img_saturn    = load_mipmaps(sat)
+        img_gargantua = load_mipmaps(gar)
+    else:
+        img_saturn    = load_texture(sat, sidecar=sidecar)
+        img_gargantua = load_texture(gar, sidecar=sidecar)
     print('Pictures ready!')
     print('Making wormhole...')
-    picture = make_picture(pic, img_saturn, img_gargantua)
+    picture = make_picture(pic, img_saturn, img_gargantua, filter, pad=1)
     print('Wormhole ready!')
     
     return picture
     
 
-def ray_to_rgb(position, saturn, theta_list, phi_list):
+def ray_to_rgb(position, saturn):
     """
     Determines values of the pixels for the rays at the Saturn side.
-    Input:  - position: tuple of theta and phi angles: [theta, phi]
-            - saturn: spherical picture of the Saturn side
-    Output: - List with RBG-values of corresponding pixel of the Saturn picture
+    Input:  - position: tuple of phi and theta arrays of the rays: [phi, theta]
+            - saturn: spherical picture of the Saturn side (photo_to_sphere)
+    Output: - Array with RBG-values of corresponding pixels of the Saturn picture
     """
     p, t = position
+    return saturn[sphere_index(saturn, t, p)]
 
-    theta_near = min(theta_list, key=lambda x: distance(x, t))
-    phi_near = min(phi_list, key=lambda x: distance(x, p))
-    nearest = (theta_near, phi_near)
-    RGB = saturn[nearest]
 
-    return RGB
+def decide_universe(photo, saturn, gargantua):
+    """
+    Decides whether ray is in Saturn or Gargantua universe and looks up the
+    RGB values of the pixels on the according sphere.
+    Input:  - photo:     solved ray tracer
+            - saturn: spherical picture of the Saturn side
+            - gargantua: spherical picture of the other side
+    Output: - picture:   Matrix with RGB values for cv2, black for rays
+                         without an endpoint (nan)
+    """
+    l, phi, theta = np.moveaxis(np.asarray(photo), -1, 0)
+    Lost = ~(np.isfinite(l) & np.isfinite(phi) & np.isfinite(theta))
+    phi, theta = np.where(Lost, 0, phi), np.where(Lost, 0, theta)
+    Neg = (l < 0)[..., None]
+    picture = np.where(Neg, ray_to_rgb((phi, theta), gargantua), ray_to_rgb((phi, theta), saturn))
+    return np.where(Lost[..., None], 0, picture)
 
 
 def make_wormhole_pic(pic, sat, gar):
     """
     Script to run wormhole picture as a whole.
     """
-    img_saturn, img_gargantua, theta_list, phi_list = read_in_pictures(sat, gar)
+    img_saturn, img_gargantua = read_pics(sat, gar)
     saturn = photo_to_sphere(img_saturn)
     gargantua = photo_to_sphere(img_gargantua)
     print('Pictures ready!')
     print('Making wormhole...')
-    picture = decide_universe(pic, saturn, gargantua, theta_list, phi_list)
+    picture = decide_universe(pic, saturn, gargantua)
     print('Wormhole ready!')
     return picture
@@ -1,80 +1,26 @@
 import numpy as np
 import time
+import os
+import inspect
 import WormholeGraphics as wg
 import Symplectic_DNeg as Smpl
+import RungeKutta as RK
+import Camera as Cam
+import Reduction as Red
+import Storage as St
 import scipy.integrate as integr
-from math import floor
+from scipy.interpolate import PchipInterpolator
+from multiprocessing import Pool
+from contextlib import nullcontext
 from tqdm.auto import tqdm
 #import scipy as sc
 
 
 
-#Dit is op de master branch:
-def dneg_r(l, M , rho, a):
-    # input: scalars
-    # output: scalar
-    # define r(l) for a DNeg wormhole without gravity
-
-    r = np.empty(l.shape)
-    l_abs = np.abs(l)
-    l_con = l_abs >= a
-    inv_l_con = ~l_con
-
-    x = 2*(l_abs[l_con] - a)/(np.pi*M)
-    r[l_con] = rho + M*(x*np.arctan2(2*(l_abs[l_con] - a), np.pi*M) - 0.5*np.log(1 + x**2))
-    r[inv_l_con] = rho
-    return r
-
-def dneg_dr_dl(l, M, a):
-    # input:scalars
-    # output: scalar
-    # define derivative of r to l
-
-    dr_dl = np.empty(l.shape)
-    l_abs = np.abs(l)
-    l_con = l_abs >= a
-    inv_l_con = ~l_con
-
-    x = 2*(l_abs[l_con] - a)/(np.pi*M)
-    dr_dl[l_con] = (2/np.pi)*np.arctan(x)*np.sign(l[l_con])
-    dr_dl[inv_l_con] = 0
-
-    return dr_dl
-
-
-def dneg_d2r_dl2(l, M, a):
-    # input: scalars
-    # output: scalars
-    # define second derivative of r to l
-
-    d2r_dl2 = np.empty(l.shape)
-    l_abs = np.abs(l)
-    l_con = l_abs >= a
-    inv_l_con = ~l_con
-
-    d2r_dl2[l_con] = (4*M)/(4*a**2 + M**2*np.pi**2 + 4*l[l_con]**2 - 8*a*l_abs[l_con])
-    d2r_dl2[inv_l_con] = 0
-
-    return d2r_dl2
-
-
-def screen_cart(Nz, Ny, L1 = 1, L2=2):
-     # input: Nz amount of pixels on vertical side screen
-     #        Ny amount pixels horizontal side screen ,
-     #        L = physical width and lenght of the screen.
-     # output: 3D matrix (2d matrix of each ray/pixel, containing its location in 3D space)
-
-    My = np.linspace(-L2/2, L2/2, Ny)
-    Mz = np.linspace(-L1/2, L1/2, Nz)
-     #cartesian product My X Mz
-    arr = []
-    for j in range(Nz):
-        for i in range(Ny):
-            # Placed at x = 1, (y,z) in My X Mz
-            arr.append([3.3, My[i],Mz[j]]) #(x, y, z)
-
-    return np.array(arr).reshape(Nz, Ny, 3) #Flat array into matrix
-
+# input: Nz, Ny amount of pixels on vertical and horizontal side screen,
+#        L1, L2 = physical height and width of the screen
+# output: 3D matrix (2d matrix of each ray/pixel, containing its location in 3D space)
+screen_cart = Cam.screen_cart
 
 
 def cart_Sph(v):
@@ -110,7 +56,6 @@ def inn_momenta(S_c, S_sph, Cst_f, inn_p_f, Par):
     #         Cst: list of cst of motion containing the value for each ray in 2D matrix
 
     r, phi, theta = S_sph
-    M, rho, a = Par
     Sh = S_sph[0].shape
     S_n = S_c/r.reshape(tuple(list(Sh) + [1])) # normalize direction light rays
     S_n = np.transpose(S_n, tuple(np.roll(np.arange(len(Sh)+1), 1))) # start array in terms of coordinates
@@ -120,6 +65,17 @@ def inn_momenta(S_c, S_sph, Cst_f, inn_p_f, Par):
     return [p, Cst]
 
 
+def camera_momenta(camera, Par, offset = 0):
+    # input: camera: Cam.Pinhole_Camera, Par: wormhole parameters,
+    #        offset: added to the position of the camera
+    # output: p: initial momenta of the pixels (unit directions in the local
+    #         frame of the camera), q: their position, Cst: constants of motion
+    q = camera.q(offset)
+    p = inn_mom_DNeg(camera.S_n(), q, Par)
+    Cst = Cst_DNeg(p, q)
+    return p, q, Cst
+
+
 def Cst_DNeg(p, q):
     # input: p: matrix with coordinates in momentum space on first row,
     #        q: matrix with coordinates in configuration space on first row ,
@@ -145,10 +101,9 @@ def inn_mom_DNeg(S_n, q, Par):
     #         a 2D matrix within that with the value for each ray
 
     l, phi, theta = q
-    M, rho, a = Par
 
     # defining r(l)
-    r = dneg_r(l, M, rho, a)
+    r = Smpl.Metric(l, Par)[0]
 
     # defining the momenta
     p_l = -S_n[0]
@@ -159,46 +114,201 @@ def inn_mom_DNeg(S_n, q, Par):
     return p
 
 
-def Simulate_DNeg(integrator, Par, h, N, q0, Nz = 14**2, Ny = 14**2, Gr_D = '2D', mode = False, Grid_constr_3D = None, Rad = False):
-    #input: function that integrates(p(t), q(t)) to (p(t + h), q(t + h))
+def Motion_store(Sh, path = None, dtype = np.float32):
+    # input: Sh: shape of the Motion array, path: optional .npy file
+    # output: array for the snapshots, in RAM or, when a path is given,
+    #         a memory mapped .npy file the snapshots are streamed to; only the
+    #         pages being written are held in memory
+    if path is None:
+        return np.empty(Sh, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(Sh))
+
+
+def load_Motion(path):
+    # input: path: .npy file written through Motion_path
+    # output: read-only memory mapped Motion, slices are read from disk lazily
+    return np.load(path, mmap_mode='r')
+
+
+def save_checkpoint(path, **State):
+    # input: path: checkpoint file, State: arrays to store
+    # a job killed while writing leaves the previous checkpoint intact (see St.atomic_save)
+    St.atomic_save(path, np.savez, **State)
+
+
+def load_checkpoint(path):
+    # input: path: checkpoint file written by save_checkpoint
+    # output: dictionary with the stored arrays
+    with np.load(path, allow_pickle=False) as Chk:
+        return {k: Chk[k] for k in Chk.files}
+
+
+def resume_DNeg(integrator, Chk_path, Par = None, Grid_constr_3D = None):
+    # input: integrator: as in Simulate_DNeg, Chk_path: checkpoint of the run,
+    #        Par: wormhole parameters, only needed when the run used a tabulated
+    #             profile (these are not stored in the checkpoint)
+    #        Grid_constr_3D: as in Simulate_DNeg
+    # output: output of Simulate_DNeg, continued from the last checkpoint with the
+    #         arguments of the interrupted run, the initial rays (of the screen or
+    #         the camera) are taken from the checkpoint
+    Chk = load_checkpoint(Chk_path)
+    if Par is None:
+        Par = list(Chk['Par'])
+    l_esc = float(Chk['l_esc']) if Chk['l_esc'].size else None
+    Motion_path = str(Chk['Motion_path']) if Chk['Motion_path'].size else None
+    return Simulate_DNeg(integrator, Par, float(Chk['h']), int(Chk['N']), Chk['q0'],
+                         int(Chk['Nz']), int(Chk['Ny']), str(Chk['Gr_D']), bool(Chk['mode']),
+                         Grid_constr_3D, bool(Chk['Rad']), bool(Chk['inplace']), l_esc,
+                         Motion_path = Motion_path, Chk_path = Chk_path,
+                         Chk_every = int(Chk['Chk_every']), resume = True)
+
+
+def Simulate_DNeg(integrator, Par, h, N, q0, Nz = 14**2, Ny = 14**2, Gr_D = '2D', mode = False, Grid_constr_3D = None, Rad = False, inplace = False, l_esc = None, tol = None, Motion_path = None, Chk_path = None, Chk_every = 10000, resume = False, camera = None, observer = None):
+    #input: function that integrates(p(t), q(t)) to (p(t + h), q(t + h)), called as
+    #       integrator(p, q, Cst, h_vect, Par, P, Q, r, dr, d2r, S) and returning
+    #       (p, q, CM, time) like Smpl.Sympl_DNeg. When it takes a CM argument it
+    #       gets CM = False on the steps whose constants of motion are not
+    #       recorded and may return None for them
     #       h: stepsize
     #       N amount of steps
     #       Ni pixels
     #       q0: initial position
     #       mode: enables data collection
+    #       inplace: step p and q in place with Horner's rule, no Taylor tables
+    #       l_esc: escape radius, rays beyond it moving outward are finished with
+    #              freeze_DNeg and dropped from the working arrays (implies inplace),
+    #              recorded snapshots hold escaped rays at the state they escaped in,
+    #              frozen rays are no longer tested against the grid, so with
+    #              Gr_D = '3D' l_esc should lie beyond the grid radius 12
+    #       tol: tolerance on the local error, steps each ray adaptively with
+    #            Smpl.Sympl_DNeg_adaptive over the time (N-1)*h starting from the
+    #            stepsize h, integrator should then be Smpl.Sympl_DNeg, or
+    #            Smpl.Sympl_DNeg_par to step on all cores. Cannot be combined with l_esc, inplace, Chk_path or resume. With
+    #            Gr_D = '3D' the grid is tested at the (at most 1000) snapshot
+    #            times instead of every step, so it can miss hits of the fixed step
+    #       Motion_path: .npy file the snapshots are streamed to instead of RAM,
+    #                    read them back lazily with load_Motion
+    #       Chk_path: file the state is checkpointed to every Chk_every steps
+    #       resume: continue from Chk_path when it exists (see resume_DNeg), the
+    #               result is identical to an uninterrupted run, the initial rays
+    #               are those stored in the checkpoint (camera is not needed)
+    #       camera: Cam.Pinhole_Camera, replaces the screen, q0, Nz and Ny,
+    #               Cam.screen_camera(q0, Nz, Ny, 1, 1) has the field of view of the screen
+    #       observer: Observer.CM_Observer, follows the drift of the constants of
+    #                 motion at its own cadence (in snapshots with tol), after a
+    #                 resume its statistics only cover the remaining steps
     #output: motion: 5D matrix the elements being [p, q] p, q being 3D matrices
     #        output: 2D boolean array
 
-    if Rad == False:
-        S_c = screen_cart(Nz, Ny, 1, 1)
-        S_cT = np.transpose(S_c, (2,0,1))
+    if tol is not None:
+        Unsupported = [k for k, v in [('l_esc', l_esc is not None), ('inplace', inplace),
+                                      ('Chk_path', Chk_path is not None), ('resume', resume)] if v]
+        if Unsupported:
+            raise ValueError('tol cannot be combined with ' + ', '.join(Unsupported))
+        if integrator is not Smpl.Sympl_DNeg and integrator is not Smpl.Sympl_DNeg_par:
+            raise ValueError('tol steps with Smpl.Sympl_DNeg_adaptive, integrator should be '
+                             'Smpl.Sympl_DNeg or Smpl.Sympl_DNeg_par, got ' + getattr(integrator, '__name__', str(integrator)))
+    if l_esc is not None and Gr_D == '3D' and l_esc <= 12:
+        raise ValueError('l_esc should lie beyond the grid radius 12 with Gr_D = \'3D\', got ' + str(l_esc))
+    resume = resume and Chk_path is not None and os.path.exists(Chk_path)
+    if resume:
+        # the rays the interrupted run started with, also when they came from a camera
+        Chk = load_checkpoint(Chk_path)
+        p, q = Chk['p_0'], Chk['q_0']
+        Sh = q[0].shape
+    elif camera is not None:
+        q0, Nz, Ny = camera.q0, camera.Nz, camera.Ny
+        p, q, Cst = camera_momenta(camera, Par, h*0.001)
+        Sh = q[0].shape
     else:
-        end = int(np.ceil(np.sqrt(Ny**2+Nz**2)))
-        S_c = screen_cart(end, end)
-        S_c = S_c[ int(end/2) - 1, int(end/2 - 1):end, :]
-        S_cT = S_c.T
-        
-    Sh = S_cT[0].shape 
-    q = np.transpose(np.tile(q0, tuple(list(Sh) + [1])), tuple(np.roll(np.arange(len(Sh)+1), 1))) + h*0.001
-    p, Cst = inn_momenta(S_c, q, Cst_DNeg, inn_mom_DNeg, Par)
+        if Rad == False:
+            S_c = screen_cart(Nz, Ny, 1, 1)
+            S_cT = np.transpose(S_c, (2,0,1))
+        else:
+            end = int(np.ceil(np.sqrt(Ny**2+Nz**2)))
+            S_c = screen_cart(end, end)
+            S_c = S_c[ int(end/2) - 1, int(end/2 - 1):end, :]
+            S_cT = S_c.T
+            
+        Sh = S_cT[0].shape 
+        q = Cam.screen_q(q0, Sh, h*0.001)
+        p, Cst = inn_momenta(S_c, q, Cst_DNeg, inn_mom_DNeg, Par)
     if N <= 1000:
         M = N
     else:
         M = 1000
         
-    Motion = np.empty(tuple([M,2,3] + list(Sh)), dtype=np.float32)
+    if resume and Motion_path is not None:
+        Motion = np.load(Motion_path, mmap_mode='r+')
+    else:
+        Motion = Motion_store([M,2,3] + list(Sh), Motion_path)
     Motion[0] = [p, q]
+    if Chk_path is not None:
+        p_0, q_0 = np.array(p, dtype=np.float64), np.array(q, dtype=np.float64)
     CM_0 = np.array(DNeg_CM(p, q , Par))
     CM = np.empty(tuple([M]+list(CM_0.shape)), dtype=np.float32)
     CM[0] = CM_0
     Grid = np.zeros((Nz, Ny), dtype=bool)
+    if observer is not None:
+        observer.start(p, q)
+
+    if tol is not None:
+        # each ray takes its own steps between evenly spaced snapshots
+        p = np.array(p, dtype=np.float64, order='C')
+        q = np.array(q, dtype=np.float64, order='C')
+        t = np.zeros(p[0].shape)
+        h_r = np.full(p[0].shape, float(h))
+        nstep = np.zeros(p[0].shape, dtype=np.int64)
+        parallel = integrator is Smpl.Sympl_DNeg_par
+        if mode == True or Gr_D == '3D':
+            T_rec = (N-1)*h*np.arange(1, M)/(M-1)
+        else:
+            T_rec = [(N-1)*h]
+        start = time.time()
+        Time = 0
+        for k in tqdm(range(len(T_rec))):
+            p, q, dt = Smpl.Sympl_DNeg_adaptive(p, q, t, h_r, T_rec[k], tol, Par, nstep, parallel = parallel)
+            Time += dt
+            if mode == True:
+                Motion[k+1] = [p, q]
+                CM[k+1] = DNeg_CM(p, q, Par)
+            if Gr_D == '3D':
+                Grid = Grid_constr_3D(q, 9, 12, 0.012, Grid)
+            if observer is not None and observer.due(k+1):
+                observer.observe(k+1, p, q)
+        Motion[-1] = [p, q]
+        if Motion_path is not None:
+            Motion.flush()
+        end = time.time()
+        print(end - start)
+        print("Time spent:" + str(Time))
+        print(f'Average number of steps is: {np.mean(nstep)}.')
+        if np.any(np.isnan(t)):
+            print(f'{np.sum(np.isnan(t))} rays stopped (non-finite error estimate or too many steps).')
+        return Motion, Grid, CM
     
     Sh = tuple([3,6]+list(p[0].shape))
     n = len(Sh)
-    P = np.zeros(Sh)
-    Q = np.zeros(Sh)
-    P[:,0] = p
-    Q[:,0] = q
+    if l_esc is not None:
+        inplace = True
+    if inplace == False:
+        P = np.zeros(Sh)
+        Q = np.zeros(Sh)
+        P[:,0] = p
+        Q[:,0] = q
+    else:
+        # state is updated in place, P only receives H, b and B_2 of each ray
+        p = np.array(p, dtype=np.float64, order='C')
+        q = np.array(q, dtype=np.float64, order='C')
+        if l_esc is not None:
+            # active set: the live rays are stored flat and compacted when rays escape
+            p_all, q_all = p, q
+            p = p_all.reshape(3, -1).copy()
+            q = q_all.reshape(3, -1).copy()
+            Active = np.arange(p.shape[1])
+            Frozen = []
+        P = np.empty(p.shape)
+        Q = None
     r = np.empty(q[0].shape)
     dr = np.empty(q[0].shape)
     d2r = np.empty(q[0].shape)
@@ -209,26 +319,95 @@ def Simulate_DNeg(integrator, Par, h, N, q0, Nz = 14**2, Ny = 14**2, Gr_D = '2D'
 
     start = time.time()
     Time = np.empty(N-1)
-    # Integration
     m = 0
-    for i in tqdm(range(N-1)):
-        p, q , CM_i, Time[i] = integrator(p, q, Cst, h_vect, Par, P, Q, r, dr, d2r, S)
-        if mode == True:
+    i0 = 0
+    if resume:
+        i0, m = int(Chk['i']), int(Chk['m'])
+        Time[:i0] = Chk['Time']
+        Cst, Grid, CM = list(Chk['Cst']), Chk['Grid'], Chk['CM']
+        if Motion_path is None:
+            Motion[:m+1] = Chk['Motion']
+        if l_esc is not None:
+            p_all[:], q_all[:] = Chk['p_all'], Chk['q_all']
+            Active = Chk['Active']
+            Frozen = list(zip(np.split(Chk['Frozen_ind'], np.cumsum(Chk['Frozen_n'])[:-1]), Chk['Frozen_T']))
+            Frozen = [(Ind, float(T)) for Ind, T in Frozen if len(Ind) > 0]
+            r, dr, d2r, P = r[:len(Active)], dr[:len(Active)], d2r[:len(Active)], P[:, :len(Active)]
+        p, q = np.array(Chk['p'], order='C'), np.array(Chk['q'], order='C')
+    # integrators with a CM argument skip summing the constants of motion on
+    # the steps that are not recorded, others are called as before
+    try:
+        Params = inspect.signature(integrator).parameters.values()
+        Pass_CM = any(P_i.name == 'CM' or P_i.kind == P_i.VAR_KEYWORD for P_i in Params)
+    except (TypeError, ValueError):
+        Pass_CM = False
+    # Integration
+    for i in tqdm(range(i0, N-1)):
+        record = mode == True and (N<= 1000 or np.mod(i+1, N/1000) == 0)
+        Kw = dict(CM = record and l_esc is None) if Pass_CM else {}
+        p, q , CM_i, Time[i] = integrator(p, q, Cst, h_vect, Par, P, Q, r, dr, d2r, S, **Kw)
+        if l_esc is not None:
+            Esc = escaped_DNeg((*q, *p), l_esc)
+            if np.any(Esc):
+                Keep = ~Esc
+                p_all.reshape(3, -1)[:, Active[Esc]] = p[:, Esc]
+                q_all.reshape(3, -1)[:, Active[Esc]] = q[:, Esc]
+                Frozen.append((Active[Esc], (N-2-i)*h))
+                Active, p, q, P = Active[Keep], p[:, Keep], q[:, Keep], P[:, Keep]
+                r, dr, d2r = r[:len(Active)], dr[:len(Active)], d2r[:len(Active)]
+        if record:
             if N<= 1000:
-                Motion[i+1] = [p, q]
-                CM[i+1] =  CM_i
+                m = i+1
             else:
-                if np.mod(i+1, N/1000) == 0:
-                    m += 1
-                    Motion[m] = [p, q]
-                    CM[m] =  CM_i
+                m += 1
+            if l_esc is not None:
+                p_all.reshape(3, -1)[:, Active] = p
+                q_all.reshape(3, -1)[:, Active] = q
+                Motion[m] = [p_all, q_all]
+                CM[m] = DNeg_CM(p_all, q_all, Par)
+            else:
+                Motion[m] = [p, q]
+                CM[m] =  CM_i
         if Gr_D == '3D':
             # change parameters grid here
-            Grid = Grid_constr_3D(q, 9, 12, 0.012, Grid)
-
+            if l_esc is not None:
+                Grid_a = Grid.reshape(-1)[Active].reshape(1, -1)
+                Grid.reshape(-1)[Active] = Grid_constr_3D(q[:, None, :], 9, 12, 0.012, Grid_a)[0]
+            else:
+                Grid = Grid_constr_3D(q, 9, 12, 0.012, Grid)
+        if observer is not None and observer.due(i+1):
+            observer.observe(i+1, p, q, None if l_esc is None else Active)
+        if Chk_path is not None and np.mod(i+1, Chk_every) == 0:
+            State = dict(p=p, q=q, p_0=p_0, q_0=q_0, Cst=np.array(Cst), Grid=Grid, CM=CM, i=i+1, m=m, Time=Time[:i+1],
+                         Par=np.array(Par if not callable(Par) else [], dtype=np.float64),
+                         h=h, N=N, q0=q0, Nz=Nz, Ny=Ny, Gr_D=Gr_D, mode=mode, Rad=Rad,
+                         inplace=inplace, l_esc=np.array([] if l_esc is None else l_esc),
+                         Motion_path=np.array([] if Motion_path is None else Motion_path),
+                         Chk_every=Chk_every)
+            if Motion_path is None:
+                State['Motion'] = Motion[:m+1]
+            else:
+                Motion.flush()
+            if l_esc is not None:
+                State.update(p_all=p_all, q_all=q_all, Active=Active,
+                             Frozen_ind=np.concatenate([Ind for Ind, T in Frozen] + [np.zeros(0, dtype=Active.dtype)]),
+                             Frozen_n=np.array([len(Ind) for Ind, T in Frozen] + [0]),
+                             Frozen_T=np.array([T for Ind, T in Frozen] + [0.]))
+            save_checkpoint(Chk_path, **State)
+
+    if l_esc is not None:
+        p_all.reshape(3, -1)[:, Active] = p
+        q_all.reshape(3, -1)[:, Active] = q
+        p, q = p_all, q_all
+        for Ind, T in Frozen:
+            y = freeze_DNeg(np.concatenate((q.reshape(3, -1)[:, Ind], p.reshape(3, -1)[:, Ind])), T, Par)
+            q.reshape(3, -1)[:, Ind] = y[:3]
+            p.reshape(3, -1)[:, Ind] = y[3:]
     if mode == True:
         CM[-1] = DNeg_CM(p, q, Par)
     Motion[-1] = [p, q]
+    if Motion_path is not None:
+        Motion.flush()
     end = time.time()
     print(end - start)
     print("Time spent:" + str(np.sum(Time)))
@@ -242,7 +421,7 @@ def diff_equations(t, variables):
     Defines the differential equations of the wormhole metric
     """
     l, phi, theta, p_l, p_phi, p_th, M, rho, a, b, B = variables
-    r = dneg_r(l, M, rho, a)
+    r, dr, d2r = Smpl.DNeg_metric(l, [M, rho, a])
     rec_r = 1/r
     rec_r_2 = rec_r**2
     rec_r_3 = rec_r_2*rec_r
@@ -258,7 +437,7 @@ def diff_equations(t, variables):
     dtheta_dt   = p_th * rec_r_2
 
     dphi_dt     = b * rec_sin2 * rec_r_2
-    dpl_dt      = B * (dneg_dr_dl(l, M, a)) * rec_r_3
+    dpl_dt      = B * dr * rec_r_3
     dpth_dt     = b ** 2 * cos1 * rec_sin3 * rec_r_2
 
     diffeq = [-dl_dt, -dphi_dt, -dtheta_dt, -dpl_dt, np.zeros(dl_dt.shape), -dpth_dt, 0, 0, 0, 0, 0]
@@ -266,7 +445,135 @@ def diff_equations(t, variables):
 
 
 
-def simulate_radius(t_end, Par, q0, h, Nz = 14**2, Ny = 14**2, methode = 'BDF', mode = False):
+def diff_equations_batch(t, y, Par):
+    """
+    Hamiltonian equations of motion for a batch of rays, used with
+    RK.dopri45_batch. Same system as diff_equations, integrated forward in time.
+    Input:  - t: times of the rays (unused)
+            - y: (6, N) matrix with l, phi, theta, p_l, p_phi, p_th of each ray
+            - Par: wormhole parameters
+    Output: - (6, N) matrix with the time derivatives
+    """
+    l, phi, theta, p_l, p_phi, p_th = y
+    r, dr, d2r = Smpl.Metric(l, Par)
+    rec_r_2 = 1/r**2
+    rec_sin1 = 1/np.sin(theta)
+    rec_sin2 = rec_sin1**2
+    B = p_th**2 + p_phi**2 * rec_sin2
+
+    dydt = np.empty(y.shape)
+    dydt[0] = p_l
+    dydt[1] = p_phi * rec_sin2 * rec_r_2
+    dydt[2] = p_th * rec_r_2
+    dydt[3] = B * dr * rec_r_2/r
+    dydt[4] = 0
+    dydt[5] = p_phi ** 2 * np.cos(theta) * rec_sin2*rec_sin1 * rec_r_2
+    return dydt
+
+
+def escaped_DNeg(y, l_esc):
+    # input: y: (6, N) l, phi, theta, p_l, p_phi, p_th of each ray, l_esc: escape radius
+    # output: boolean array, rays beyond l_esc moving away from the throat
+    return (np.abs(y[0]) > l_esc) & (y[3]*y[0] > 0)
+
+
+def freeze_DNeg(y, T, Par):
+    """
+    Advances escaped rays analytically along straight lines. Far from the
+    throat space is close to flat, so the celestial direction of a ray no
+    longer changes appreciably. The line is followed in r, the end point is
+    mapped back to l with the inverse of r(l) on the side of the ray.
+    Input:  - y: (6, N) l, phi, theta, p_l, p_phi, p_th of each ray
+            - T: time left for each ray
+            - Par: wormhole parameters
+    Output: - (6, N) state of the rays after the time T
+    """
+    l, phi, theta, p_l, p_phi, p_th = y
+    r, dr, d2r = Smpl.Metric(l, Par)
+    sin1, cos1 = np.sin(theta), np.cos(theta)
+
+    # position and velocity in the flat space far from the throat, with the
+    # same rates of change of r, phi and theta as the ray has now
+    X = Sph_cart([r, phi, theta])
+    e_th = np.array([cos1*np.cos(phi), cos1*np.sin(phi), -sin1])
+    e_phi = np.array([-np.sin(phi), np.cos(phi), np.zeros(phi.shape)])
+    V = dr*p_l*X/r + p_th/r*e_th + p_phi/(r*sin1)*e_phi
+    r_T, phi_T, theta_T = cart_Sph(X + T*V)
+
+    # l_T with r(l_T) = r_T by Newton's method, r(l) is convex in |l| outside
+    # the throat so the iterates approach it from beyond after the first step
+    l_T = l + (r_T - r)/dr
+    for k in range(50):
+        r_k, dr_T = Smpl.Metric(l_T, Par)[:2]
+        dl = (r_k - r_T)/dr_T
+        l_T = l_T - dl
+        if np.all(np.abs(dl) <= 1e-14*np.abs(l_T)):
+            break
+    dr_T = Smpl.Metric(l_T, Par)[1]
+
+    sin1, cos1 = np.sin(theta_T), np.cos(theta_T)
+    e_r = np.array([sin1*np.cos(phi_T), sin1*np.sin(phi_T), cos1])
+    e_th = np.array([cos1*np.cos(phi_T), cos1*np.sin(phi_T), -sin1])
+    y_T = np.empty(y.shape)
+    y_T[0] = l_T
+    y_T[1] = np.mod(phi_T, 2*np.pi)
+    y_T[2] = theta_T
+    # dr/dt = dr/dl p_l
+    y_T[3] = np.sum(V*e_r, axis=0)/dr_T
+    y_T[4] = p_phi
+    y_T[5] = r_T*np.sum(V*e_th, axis=0)
+    return y_T
+
+
+def simulate_batch(p, q0, Par, t_end, t_eval = None, rtol = 1e-3, atol = 1e-6, l_esc = None, out = None, block_rows = None):
+    """
+    Integrates all rays of a screen at once with the batched Dormand-Prince
+    integrator instead of calling solve_ivp per pixel.
+    Input:  - p: initial momenta, coordinates on the first axis
+            - q0: position of the camera
+            - Par: wormhole parameters
+            - t_end: integration time
+            - t_eval: times in [0, t_end] to store, None only keeps the endpoint
+            - rtol, atol: tolerances of the error control
+            - l_esc: escape radius, rays beyond it moving outward are finished
+              analytically with freeze_DNeg
+            - out: optional (len(t_eval), 2, 3, *screen) array, e.g. from
+              Motion_store, the rows of the screen are then integrated in blocks
+              and each block is written into it as [p, q]
+            - block_rows: rows per block for out, by default about 2**22 samples
+    Output: - Y: (6, *screen, len(t_eval)) or (6, *screen) with l, phi, theta,
+              p_l, p_phi, p_th, phi and theta taken modulo 2pi and pi, or out
+            - nfev: amount of function evaluations of each ray
+            - success: False for the rays the integrator gave up on, their
+              samples from that point on are nan
+    """
+    Sh = p[0].shape
+    if out is not None:
+        # every ray has its own error control, so blocks give the same result
+        Rest = int(np.prod(Sh[1:]))
+        if block_rows is None:
+            block_rows = max(1, 2**22//(6*Rest*len(t_eval)))
+        nfev = np.empty(Sh, dtype=int)
+        success = np.empty(Sh, dtype=bool)
+        for R0 in range(0, Sh[0], block_rows):
+            R = slice(R0, min(R0 + block_rows, Sh[0]))
+            Y, nfev[R], success[R] = simulate_batch(p[:, R], q0, Par, t_end, t_eval, rtol, atol, l_esc)
+            # (l, phi, theta, p_l, p_phi, p_th, rows, ..., t) to (t, [p, q], 3, rows, ...)
+            out[:, :, :, R] = np.moveaxis(Y.reshape((2, 3) + Y.shape[1:])[::-1], -1, 0)
+        return out, nfev, success
+    y0 = np.empty((6, p[0].size))
+    y0[:3] = np.reshape(q0, (3, 1))
+    y0[3:] = p.reshape(3, -1)
+    escape = None
+    if l_esc is not None:
+        escape = (lambda y, Par: escaped_DNeg(y, l_esc), freeze_DNeg)
+    Y, nfev, success = RK.dopri45_batch(diff_equations_batch, [0, t_end], y0, rtol, atol, t_eval, (Par,), escape)
+    Y[1] = np.mod(Y[1], 2*np.pi)
+    Y[2] = np.mod(Y[2], np.pi)
+    return Y.reshape((6,) + Sh + Y.shape[2:]), nfev.reshape(Sh), success.reshape(Sh)
+
+
+def simulate_radius(t_end, Par, q0, h, Nz = 14**2, Ny = 14**2, methode = 'BDF', mode = False, l_esc = None):
     """
     Solves the differential equations using a build in solver (solve_ivp) with
     specified method.
@@ -275,7 +582,9 @@ def simulate_radius(t_end, Par, q0, h, Nz = 14**2, Ny = 14**2, methode = 'BDF',
             - q0: position of the camera
             - Nz: number of vertical pixels
             - Ny: number of horizontal pixels
-            - methode: method used for solving the ivp (standerd runge-kutta of fourth order)
+            - methode: method used for solving the ivp (standerd runge-kutta of fourth order),
+                       'batch' integrates all rays at once with RK.dopri45_batch
+            - l_esc: escape radius for methode 'batch', see simulate_batch
             - h: absolute tolerance / min stepsize
 
     Output: - endmom: matrix with the momenta of the solution
@@ -289,7 +598,7 @@ def simulate_radius(t_end, Par, q0, h, Nz = 14**2, Ny = 14**2, methode = 'BDF',
     S_c = screen_cart(end, end) 
     S_cT = S_c.T
     Sh = S_cT[0].shape 
-    q_v = np.transpose(np.tile(q0, tuple(list(Sh) + [1])), tuple(np.roll(np.arange(len(Sh)+1), 1))) + h*0.001
+    q_v = Cam.screen_q(q0, Sh, h*0.001)
     p, Cst = inn_momenta(S_c, q_v, Cst_DNeg, inn_mom_DNeg, Par)
     p1, p2, p3 = p
     if mode == True:
@@ -304,13 +613,19 @@ def simulate_radius(t_end, Par, q0, h, Nz = 14**2, Ny = 14**2, methode = 'BDF',
     #Loop over half of the screen
     print('Integrating ray...')
     nstep = []
-    for teller2 in tqdm(range(int(len(p1[0])/2 - 1), len(p1[0]))):
-        initial_values = np.array([q1, q2, q3, p1[teller1][teller2], p2[teller1][teller2], p3[teller1][teller2], M, rho, a, Cst[0,teller1,teller2], Cst[1,teller1,teller2]])
-        # Integrate to the solution
-        i = teller2 - int(len(p1[0])/2 - 1)
-        sol = integr.solve_ivp(diff_equations, [0, -t_end], initial_values, method = methode, t_eval=data, rtol=h**(1/2), atol=h)
-        Motion[i] = sol.y[:6]
-        nstep.append(sol.nfev)
+    if methode == 'batch':
+        Row = p[:, teller1, int(len(p1[0])/2 - 1):]
+        Y, nfev, success = simulate_batch(Row, q0, Par, t_end, -np.array(data), h**(1/2), h, l_esc)
+        Motion[:] = np.transpose(Y.reshape(6, len(Motion), T), (1,0,2))
+        nstep = list(nfev)
+    else:
+        for teller2 in tqdm(range(int(len(p1[0])/2 - 1), len(p1[0]))):
+            initial_values = np.array([q1, q2, q3, p1[teller1][teller2], p2[teller1][teller2], p3[teller1][teller2], M, rho, a, Cst[0,teller1,teller2], Cst[1,teller1,teller2]])
+            # Integrate to the solution
+            i = teller2 - int(len(p1[0])/2 - 1)
+            sol = integr.solve_ivp(diff_equations, [0, -t_end], initial_values, method = methode, t_eval=data, rtol=h**(1/2), atol=h)
+            Motion[i] = sol.y[:6]
+            nstep.append(sol.nfev)
     print(np.amax(Motion[:,1]))
     Motion[:,1] = np.mod(Motion[:,1], 2*np.pi)
     Motion[:,2] = np.mod(Motion[:,2], np.pi)
@@ -320,66 +635,161 @@ def simulate_radius(t_end, Par, q0, h, Nz = 14**2, Ny = 14**2, methode = 'BDF',
     return Motion[:, 3:], Motion[:, :3]
 
 
-def simulate_raytracer(tijd = 100, Par = [0.43/1.42953, 1, 0.48], q0 = [6.68, np.pi, np.pi/2], Nz = 14**2, Ny = 14**2, methode = 'RK45'):
+def refine_rays(x, trace, gap, tol, n_max, dx_min):
     """
-    Solves the differential equations using a build in solver (solve_ivp) with
-    specified method.
+    Samples a family of rays with one parameter x, halving the intervals
+    where neighbouring rays end up more than tol apart, the largest gaps first.
+    Used by simulate_radius_adaptive and Animation.psi_profile.
+    Input:  - x: sorted initial parameters of the rays
+            - trace: function x -> Y, the endpoints of the rays on the second axis
+            - gap: function Y -> distance between the endpoints of neighbours
+            - tol: largest gap that is not split
+            - n_max: largest amount of rays
+            - dx_min: intervals shorter than this are not split further
+    Output: - x: sorted parameters of the rays
+            - Y: their endpoints
+    """
+    Y = trace(x)
+    while len(x) < n_max:
+        d = gap(Y)
+        Split = np.nonzero((d > tol) & (np.diff(x) > dx_min))[0]
+        if len(Split) == 0:
+            break
+        Split = Split[np.argsort(-d[Split])][:n_max - len(x)]
+        new = 0.5*(x[Split] + x[Split + 1])
+        Y = np.concatenate((Y, trace(new)), axis=1)
+        x = np.concatenate((x, new))
+        Order = np.argsort(x)
+        x, Y = x[Order], Y[:, Order]
+    return x, Y
+
+
+def simulate_radius_adaptive(t_end, Par, q0, h, Nz = 14**2, Ny = 14**2, n0 = 33, n_max = 257, dpsi = 0.02, l_esc = None):
+    """
+    Integrates the 'horizontal' ray of simulate_radius only at a sparse set of
+    pixel radii, refined where the exit directions of neighbouring rays are far
+    apart (near the photon ring) or lie on different sides of the wormhole.
+    The rays are integrated with simulate_batch, pass the radii to
+    rotation_qubits to interpolate between them.
     Input:  - t_end: endtime of the Integration
             - Par: wormhole parameters
             - q0: position of the camera
+            - h: absolute tolerance, the relative tolerance is h**(1/2)
             - Nz: number of vertical pixels
             - Ny: number of horizontal pixels
-            - methode: method used for solving the ivp (standerd runge-kutta of fourth order)
-
-    Output: - endmom: matrix with the momenta of the solution
+            - n0: amount of evenly spaced radii to start from
+            - n_max: largest amount of rays
+            - dpsi: largest angle [rad] between the exit directions of neighbours
+            - l_esc: escape radius, see simulate_batch
+    Output: - radii: pixel radius of each ray, sorted
+            - endmom: matrix with the momenta of the solution
             - endpos: matrix with the positions of the solution
     """
-    print('Initializing screen and calculating initial condition...')
+    # the same screen line as simulate_radius: pixel radius k lies on column
+    # s + k of a screen with end x end pixels, in the row just below the centre
+    end = int(np.ceil(np.sqrt(Ny**2+Nz**2)))
+    s = int(end/2 - 1)
+    y0 = -1 + 2*s/(end-1)
+    z0 = -0.5 + (int(end/2) - 1)/(end-1)
+    R = end - s - 1
+
+    def trace(radii):
+        S_c = np.zeros((1, len(radii), 3))
+        S_c[..., 0] = 3.3
+        S_c[..., 1] = y0 + 2*radii/(end-1)
+        S_c[..., 2] = z0
+        q_v = Cam.screen_q(q0, (1, len(radii)), h*0.001)
+        p, Cst = inn_momenta(S_c, q_v, Cst_DNeg, inn_mom_DNeg, Par)
+        Y, nfev, success = simulate_batch(p[:, 0], q0, Par, t_end, None, h**(1/2), h, l_esc)
+        return Y
+
+    def gap(Y):
+        # angle between the exit directions of neighbouring rays
+        u = Sph_cart(np.array([np.ones(Y.shape[1]), Y[1], Y[2]]))
+        cos_psi = np.sum(u[:, 1:]*u[:, :-1], axis=0)
+        psi = np.arccos(np.clip(cos_psi, -1, 1))
+        psi[np.sign(Y[0, 1:]) != np.sign(Y[0, :-1])] = np.pi
+        return psi
 
-    # end = int(np.ceil(np.sqrt(Ny**2+Nz**2)))
-    M, rho, a = Par
+    print('Integrating ray...')
+    # intervals smaller than a tenth of a pixel are not split further
+    radii, Y = refine_rays(np.linspace(0, R, n0), trace, gap, dpsi, n_max, 0.1)
+    print('radius saved!')
+    print(f'Amount of rays is: {len(radii)}.')
+    Motion = Y.T[:, :, None]
+    return radii, Motion[:, 3:], Motion[:, :3]
 
-    # Reading out values and determining parameters
-    S_c = screen_cart(Nz, Ny)
-    S_cT = np.transpose(S_c, (2,0,1))
-    Sh = S_cT[0].shape 
-    q_v = np.transpose(np.tile(q0, tuple(list(Sh) + [1])), tuple(np.roll(np.arange(len(Sh)+1), 1))) + 0.00001
-    p, Cst = inn_momenta(S_c, q_v, Cst_DNeg, inn_mom_DNeg, Par)
+
+def trace_rows(args):
+    """
+    Integrates a block of rows of the screen pixel by pixel with solve_ivp.
+    Module level so it can run in the worker processes of map_rows.
+    Input:  - args: (p, Cst, q0, Par, t_span, t_eval, methode, fullpath) with
+              p and Cst holding only the rows of the block, fullpath keeps
+              every t_eval sample instead of only the endpoint
+    Output: - endmom: list with the momenta of each row
+            - endpos: list with the positions of each row
+            - Time: integration time of each pixel
+            - Success: False for the pixels solve_ivp failed on, their samples
+              from that point on are nan
+    """
+    p, Cst, q0, Par, t_span, t_eval, methode, fullpath = args
+    M, rho, a = Par
     p1, p2, p3 = p
     q1, q2, q3 = q0
     endpos = []
     endmom = []
+    Time = np.empty(p1.shape)
+    Success = np.empty(p1.shape, dtype=bool)
 
-    # Looping over all momenta
-    for teller1 in tqdm(range(0, len(p1))):
+    for teller1 in range(0, len(p1)):
         row_pos = []
         row_mom = []
-        start_it = time.time()
         for teller2 in range(0, len(p1[0])):
 
-            start_it = time.time()
             initial_values = np.array([q1, q2, q3, p1[teller1][teller2], p2[teller1][teller2], p3[teller1][teller2], M, rho, a, Cst[0,teller1,teller2], Cst[1,teller1,teller2]])
             # Integrates to the solution
-            sol = integr.solve_ivp(diff_equations, [tijd, 0], initial_values, method = methode, t_eval=[0])
-            #Reads out the data from the solution
-            l_end       = sol.y[0][-1]
-            phi_end     = sol.y[1][-1]
-
-            # Correcting for phi and theta values out of bounds
-            while phi_end>2*np.pi:
-                phi_end = phi_end - 2*np.pi
-            while phi_end<0:
-                phi_end = phi_end + 2*np.pi
-
-            theta_end   = sol.y[2][-1]
-            while theta_end > np.pi:
-                theta_end = theta_end - np.pi
-            while theta_end < 0:
-                theta_end = theta_end + np.pi
-
-            pl_end      = sol.y[3][-1]
-            pphi_end    = sol.y[4][-1]
-            ptheta_end  = sol.y[5][-1]
+            start_it = time.time()
+            sol = integr.solve_ivp(diff_equations, t_span, initial_values, method = methode, t_eval=t_eval)
+            end_it = time.time()
+            Time[teller1,teller2] = end_it - start_it
+            Success[teller1,teller2] = sol.success
+            y = sol.y[:6]
+            if not sol.success:
+                # the samples after the point the solver stopped at are missing
+                y = np.full((6, len(t_eval)), np.nan)
+                y[:, :sol.y.shape[1]] = sol.y[:6]
+            if fullpath == True:
+                #Reads out the data from the solution
+                l_end       = y[0]
+                phi_end     = y[1]
+                # Correcting for phi and theta values out of bounds
+                phi_end = np.mod(phi_end, 2*np.pi)
+                theta_end   = y[2]
+                theta_end = np.mod(theta_end, np.pi)
+                pl_end      = y[3]
+                pphi_end    = y[4]
+                ptheta_end  = y[5]
+            else:
+                #Reads out the data from the solution
+                l_end       = y[0][-1]
+                phi_end     = y[1][-1]
+
+                # Correcting for phi and theta values out of bounds
+                while phi_end>2*np.pi:
+                    phi_end = phi_end - 2*np.pi
+                while phi_end<0:
+                    phi_end = phi_end + 2*np.pi
+
+                theta_end   = y[2][-1]
+                while theta_end > np.pi:
+                    theta_end = theta_end - np.pi
+                while theta_end < 0:
+                    theta_end = theta_end + np.pi
+
+                pl_end      = y[3][-1]
+                pphi_end    = y[4][-1]
+                ptheta_end  = y[5][-1]
             # adds local solution to row
             row_pos.append(np.array([l_end, phi_end, theta_end]))
             row_mom.append(np.array([pl_end, pphi_end, ptheta_end]))
@@ -387,13 +797,98 @@ def simulate_raytracer(tijd = 100, Par = [0.43/1.42953, 1, 0.48], q0 = [6.68, np
         # adds row to matrix
         endpos.append(np.array(row_pos))
         endmom.append(np.array(row_mom))
-        end_it = time.time()
-        duration = end_it - start_it
-        # print('Iteration ' + str((teller1, teller2)) + ' completed in ' + str(duration) + 's.')
+    return endmom, endpos, Time, Success
+
+
+def map_rows(p, Cst, q0, Par, t_span, t_eval, methode, fullpath, workers = 1, Motion = None):
+    """
+    Distributes the rows of the screen over a process pool in blocks and
+    reassembles the results in the original row order.
+    Input:  - p, Cst: initial momenta and constants of motion of the screen
+            - q0, Par, t_span, t_eval, methode, fullpath: see trace_rows
+            - workers: amount of processes, 1 runs in this process
+              (scripts using workers > 1 need an if __name__ == '__main__' guard
+              on platforms that spawn processes)
+            - Motion: optional (len(t_eval), 2, 3, Nz, Ny) array for fullpath, each
+              finished block of rows is written into it instead of the lists
+    Output: - endmom, endpos: lists with a row of momenta/positions for each row
+            - Time: integration time of each pixel
+            - Success: False for the pixels solve_ivp failed on (see trace_rows)
+    """
+    Nz = len(p[0])
+    # several blocks per worker to balance rows that take longer
+    n_blocks = Nz if workers == 1 else min(Nz, 4*workers)
+    Rows = [R for R in np.array_split(np.arange(Nz), n_blocks) if len(R) > 0]
+    Tasks = [(p[:, R[0]:R[-1]+1], Cst[:, R[0]:R[-1]+1], q0, Par, t_span, t_eval, methode, fullpath)
+             for R in Rows]
+
+    endmom = []
+    endpos = []
+    Time = []
+    Success = []
+    pbar = tqdm(total=Nz)
+    # the pool is terminated on leaving the block, also when a row fails
+    with (Pool(workers) if workers != 1 else nullcontext()) as pool:
+        Results = map(trace_rows, Tasks) if pool is None else pool.imap(trace_rows, Tasks)
+        for R, (mom, pos, T, S) in zip(Rows, Results):
+            if Motion is None:
+                endmom += mom
+                endpos += pos
+            else:
+                # (rows, Ny, 3, t) to (t, 3, rows, Ny)
+                Motion[:, 0, :, R[0]:R[-1]+1] = np.transpose(np.array(mom), (3,2,0,1))
+                Motion[:, 1, :, R[0]:R[-1]+1] = np.transpose(np.array(pos), (3,2,0,1))
+            Time.append(T)
+            Success.append(S)
+            pbar.update(len(mom))
+    pbar.close()
+    return endmom, endpos, np.concatenate(Time), np.concatenate(Success)
+
+
+def simulate_raytracer(tijd = 100, Par = [0.43/1.42953, 1, 0.48], q0 = [6.68, np.pi, np.pi/2], Nz = 14**2, Ny = 14**2, methode = 'RK45', workers = 1, l_esc = None, camera = None):
+    """
+    Solves the differential equations using a build in solver (solve_ivp) with
+    specified method.
+    Input:  - t_end: endtime of the Integration
+            - Par: wormhole parameters
+            - q0: position of the camera
+            - Nz: number of vertical pixels
+            - Ny: number of horizontal pixels
+            - methode: method used for solving the ivp (standerd runge-kutta of fourth order),
+                       'batch' integrates all rays at once with RK.dopri45_batch
+            - l_esc: escape radius for methode 'batch', see simulate_batch
+            - workers: amount of processes the rows are distributed over
+            - camera: Cam.Pinhole_Camera, replaces the screen, q0, Nz and Ny,
+              Cam.screen_camera(q0, Nz, Ny) has the field of view of the screen
+
+    Output: - endmom: matrix with the momenta of the solution
+            - endpos: matrix with the positions of the solution
+    """
+    print('Initializing screen and calculating initial condition...')
+
+    # end = int(np.ceil(np.sqrt(Ny**2+Nz**2)))
+
+    # Reading out values and determining parameters
+    if camera is not None:
+        q0 = camera.q0
+        p, q_v, Cst = camera_momenta(camera, Par, 0.00001)
+    else:
+        S_c = screen_cart(Nz, Ny)
+        S_cT = np.transpose(S_c, (2,0,1))
+        Sh = S_cT[0].shape 
+        q_v = Cam.screen_q(q0, Sh, 0.00001)
+        p, Cst = inn_momenta(S_c, q_v, Cst_DNeg, inn_mom_DNeg, Par)
+
+    if methode == 'batch':
+        Y, nfev, success = simulate_batch(p, q0, Par, tijd, l_esc = l_esc)
+        return np.transpose(Y[3:], (1,2,0)), np.transpose(Y[:3], (1,2,0))
+
+    # Looping over all momenta
+    endmom, endpos, Time, success = map_rows(p, Cst, q0, Par, [tijd, 0], [0], methode, False, workers)
     return np.array(endmom), np.array(endpos)
 
 
-def simulate_raytracer_fullpath(t_end, Par, q0, N, Nz = 14**2, Ny = 14**2, methode = 'RK45', mode = False):
+def simulate_raytracer_fullpath(t_end, Par, q0, N, Nz = 14**2, Ny = 14**2, methode = 'RK45', mode = False, workers = 1, l_esc = None, Motion_path = None):
     """
     Solves the differential equations using a build in solver (solve_ivp) with
     specified method.
@@ -404,60 +899,36 @@ def simulate_raytracer_fullpath(t_end, Par, q0, N, Nz = 14**2, Ny = 14**2, metho
             - Ny: number of horizontal pixels
             - methode: method used for solving the ivp (standerd runge-kutta of fourth order)
             - mode enables data collection (Energy)
+            - workers: amount of processes the rows are distributed over
+            - Motion_path: .npy file Motion is written to instead of RAM, every
+              finished block of rows is written to it as the integration proceeds
 
     Output: - Motion: Usual 5D matrix
     """
     print('Initializing screen and calculating initial condition...')
 
     # end = int(np.ceil(np.sqrt(Ny**2+Nz**2)))
-    M, rho, a = Par
 
     # Reading out values and determining parameters
     S_c = screen_cart(Nz, Ny, 1, 1)
     S_cT = np.transpose(S_c, (2,0,1))
     Sh = S_cT[0].shape 
-    q_v = np.transpose(np.tile(q0, tuple(list(Sh) + [1])), tuple(np.roll(np.arange(len(Sh)+1), 1))) + 0.00001
+    q_v = Cam.screen_q(q0, Sh, 0.00001)
     p, Cst = inn_momenta(S_c, q_v, Cst_DNeg, inn_mom_DNeg, Par)
-    p1, p2, p3 = p
-    q1, q2, q3 = q0
-    endpos = []
-    endmom = []
-
-    Time = np.empty(p1.shape)
-    # Looping over all momenta
-    for teller1 in tqdm(range(0, len(p1))):
-        row_pos = []
-        row_mom = []
-        start_it = time.time()
-        for teller2 in range(0, len(p1[0])):
-  
-            initial_values = np.array([q1, q2, q3, p1[teller1][teller2], p2[teller1][teller2], p3[teller1][teller2], M, rho, a, Cst[0,teller1,teller2], Cst[1,teller1,teller2]])
-            # Integrates to the solution
-            start_it = time.time()
-            sol = integr.solve_ivp(diff_equations, [t_end, 0], initial_values, method = methode, t_eval=np.flip(np.arange(0, t_end, t_end/N)))
-            end_it = time.time()
-            Time[teller1,teller2] = end_it - start_it
-            #Reads out the data from the solution
-            l_end       = sol.y[0]
-            phi_end     = sol.y[1]
-            # Correcting for phi and theta values out of bounds
-            phi_end = np.mod(phi_end, 2*np.pi)
-            theta_end   = sol.y[2]
-            theta_end = np.mod(theta_end, np.pi)
-            pl_end      = sol.y[3]
-            pphi_end    = sol.y[4]
-            ptheta_end  = sol.y[5]
-            # adds local solution to row
-            row_pos.append(np.array([l_end, phi_end, theta_end]))
-            row_mom.append(np.array([pl_end, pphi_end, ptheta_end]))
 
-        # adds row to matrix
-        endpos.append(np.array(row_pos))
-        endmom.append(np.array(row_mom))
-        
-        # print('Iteration ' + str((teller1, teller2)) + ' completed in ' + str(duration) + 's.')
-    print("Time spent:" + str(np.sum(Time)))
-    Motion = np.transpose(np.array([endmom, endpos]), (4,0,3,1,2)) #output same shape as sympl. intgr.
+    t_eval = np.flip(np.arange(0, t_end, t_end/N))
+    # output same shape as sympl. intgr., filled block by block of rows
+    Motion = Motion_store((len(t_eval), 2, 3) + Sh, Motion_path, np.float64)
+    if methode == 'batch':
+        start = time.time()
+        Motion, nfev, success = simulate_batch(p, q0, Par, t_end, t_end - t_eval, l_esc = l_esc, out = Motion)
+        print("Time spent:" + str(time.time() - start))
+    else:
+        # Looping over all momenta
+        endmom, endpos, Time, success = map_rows(p, Cst, q0, Par, [t_end, 0], t_eval, methode, True, workers, Motion)
+        print("Time spent:" + str(np.sum(Time)))
+    if Motion_path is not None:
+        Motion.flush()
     if mode == False:
         return Motion
     else:
@@ -527,112 +998,94 @@ def carth_polar(y, z):
     return np.sqrt(y*y + z*z), np.arctan2(z,y)
 
 
-def rotation_qubits(ray, Nz, Ny):
+def interp_ray(ray, radii):
+    """
+    Monotone (PCHIP) interpolation of a ray sampled at the given pixel radii.
+    phi and theta are unwrapped before interpolating and wrapped afterwards.
+    Inputs: - ray: [l, phi, theta] of each sample
+            - radii: increasing pixel radius of each sample
+    Output: - function radius -> l, phi, theta
+    """
+    Col = np.array([ray[:, 0], np.unwrap(ray[:, 1]), np.unwrap(ray[:, 2], period=np.pi)]).T
+    f = PchipInterpolator(radii, Col, axis=0, extrapolate=True)
+
+    def ray_f(radius):
+        l, phi, theta = np.moveaxis(f(radius), -1, 0)
+        return l, np.mod(phi, 2*np.pi), np.mod(theta, np.pi)
+
+    return ray_f
+
+
+def rotation_qubits(ray, Nz, Ny, radii = None):
     """
     The function assumes a 'horizontal' ray for theta = pi/2 and phi: pi to 2pi.
     Rotation is of the 'horizontal' ray is done with qubit method.
     Inputs: - ray: the calculated 1D line
             - Nz: vertical number of pixels
             - Ny: horizontal number of pixels
+            - radii: pixel radius of each point of the ray (see
+              simulate_radius_adaptive), then the ray is interpolated with
+              interp_ray instead of taking ray[floor(radius)]
     Output: - pic: a 3D array with the pixels and their l, phi, theta
     """
 
     # Make list of point with position relative to center of the matrix
     Mz = np.arange(-Nz/2, Nz/2, 1, dtype=int)
     My = np.arange(-Ny/2, Ny/2, 1, dtype=int)
+    height, width = np.meshgrid(Mz, My, indexing='ij')
 
-    # Make the matrix to fill with the parameter values
-    pic = np.zeros((Nz, Ny, 3))
+    # Find the coordinates of every pixel in polar coordinates
+    radius, alpha = carth_polar(width, height)
 
-    # Loop over every element (pixel) of the matrix (picture)
-    for i in tqdm(range(0, len(Mz))):
-        height = Mz[i]
-        for width in My:
-
-            # Find the coordinates in polar coordinates
-            radius, alpha = carth_polar(width, height)
-
-            r = int(floor(radius))
+    # Carthesian coordinates of the gridpoints relative to upper left corner
+    z = (-height + Nz/2).astype(int) - 1
+    y = (width + Ny/2).astype(int) - 1
 
-            # Carthesian coordinates of the gridpoint relative to upper left corner
-            z = int(-height + Nz/2) - 1
-            y = int(width + Ny/2) - 1
-
-            # Get the corresponding values from the calculated ray
-            l, phi, theta = ray[r]
-
-            # Initializing qubit for rotation
-            psi = np.array([np.cos(theta/2), np.exp(phi*1j)*np.sin(theta/2)])
-
-            # Rotationmatrix (rotation axis is x-axis)
-            R_x = np.array([np.array([np.cos(alpha/2), -1j*np.sin(alpha/2)]), np.array([-1j*np.sin(alpha/2), np.cos(alpha/2)])])
-            rot_psi = np.matmul(psi, R_x) # Matrix multiplication
+    # Get the corresponding values from the calculated ray
+    if radii is None:
+        r = np.floor(radius).astype(int)
+        l, phi, theta = ray[r].transpose(2,0,1)
+    else:
+        l, phi, theta = interp_ray(ray, radii)(radius)
 
-            # Find rotated phi and theta
-            z_0, z_1 = rot_psi
+    # Initializing qubits for rotation
+    psi_0 = np.cos(theta/2)
+    psi_1 = np.exp(phi*1j)*np.sin(theta/2)
 
-            rot_theta = 2*np.arctan2(np.absolute(z_1),np.absolute(z_0))
-            rot_phi   = np.angle(z_1) - np.angle(z_0)
+    # Rotation about the x-axis in closed form, psi @ [[c, -is], [-is, c]]
+    c = np.cos(alpha/2).astype(complex)
+    s = -1j*np.sin(alpha/2)
+    z_0 = psi_0*c + psi_1*s
+    z_1 = psi_0*s + psi_1*c
 
-            loc = np.array([l, rot_phi, rot_theta])
+    # Find rotated phi and theta
+    rot_theta = 2*np.arctan2(np.absolute(z_1),np.absolute(z_0))
+    rot_phi   = np.angle(z_1) - np.angle(z_0)
 
-            pic[z][y] = loc
+    # Make the matrix to fill with the parameter values
+    pic = np.zeros((Nz, Ny, 3))
+    pic[z, y] = np.stack((l, rot_phi, rot_theta), axis=-1)
 
     return pic
 
 
-def sum_subd(A):
-    # A 2D/1D matrix such that the lengt of sides have int squares
-    Sh = A.shape
-    if len(Sh) > 1:
-        Ny, Nz =  Sh
-        Ny_s = int(np.sqrt(Ny))
-        Nz_s = int(np.sqrt(Nz))
-        B = np.zeros((Ny_s, Nz_s))
-        for i in range(Ny_s):
-            for j in range(Nz_s):
-                B[i,j] = np.sum(A[Ny_s*i:Ny_s*(i+1), Nz_s*j:Nz_s*(j+1)])
-    else:
-        N = Sh
-        N_s = int(np.sqrt(N))
-        B = np.zeros(N_s)
-        for i in range(N_s):
-            B[i] = np.sum(A[N_s*i:N_s*(i+1)])
-    return B
-
+sum_subd = Red.sum_subd
 
 
 def DNeg_CM(p, q , Par):
     #input: p, q  3D matrices as defined earlier
     #output: 1D matrix, constants of Motion defined in each timestep
-    M, rho, a = Par
-
-    p_l, p_phi, p_th = p
     l, phi, theta = q
 
     # defining r(l):
-    r = dneg_r(l, M, rho, a)
-
-    rec_r = 1/r
-    rec_r_2 = rec_r**2
-    sin1 = np.sin(theta)
-    sin2 = sin1**2
-    rec_sin2 = 1/sin2
-
-    # defining hamiltonian
-    H1 = p_l**2
-    H2 = p_th**2*rec_r_2
-    H3 = p_phi**2*rec_sin2*rec_r_2
+    r = Smpl.Metric(l, Par)[0]
 
-    H = 0.5*sum_subd(H1 + H2 + H3)
-    B2_C = sum_subd(p_th**2 + p_phi**2*rec_sin2)
-    b_C = sum_subd(p_phi)
+    # hamiltonian and constants of motion, summed over the blocks in one pass
+    return Red.sum_invariants(p, theta, r)
 
-    return [H, b_C, B2_C]
 
 
-
-def wormhole_with_symmetry(t_end=200, q0 = [7.25, np.pi, np.pi/2], Nz=1024, Ny=2048, Par=[0.05/1.42953, 1, 1], h = 10**-10, choice=True, mode=False):
+def wormhole_with_symmetry(t_end=200, q0 = [7.25, np.pi, np.pi/2], Nz=1024, Ny=2048, Par=[0.05/1.42953, 1, 1], h = 10**-10, choice=True, mode=False, tol=None, n_rays=None, cache=None):
 
     """
     One function to calculate the ray and rotate it to a full picture with the
@@ -644,30 +1097,54 @@ def wormhole_with_symmetry(t_end=200, q0 = [7.25, np.pi, np.pi/2], Nz=1024, Ny=2
             - Par: wormhole parameters [M, rho, a]
             - h: stepsize (for selfmade)
             - choice: switch build in / selfmade
+            - tol: tolerance of the adaptive symplectic integrator (selfmade), then h
+                   is only the initial stepsize
+            - n_rays: largest amount of rays (build in), integrates an adaptively
+                      refined set of radii with simulate_radius_adaptive instead
+                      of one ray per pixel of radius, only endpoints are stored
             - mode enables data collection (Energy)
+            - cache: EndpointCache.Endpoint_Cache, the endpoints of a run with the
+                     same settings are read from it instead of integrated again
     Output: - picture: a 2D matrix containing the [l, phi, theta] value of the endpoint of each pixel
     """
 
+    if cache is not None:
+        key = cache.key(run='wormhole_with_symmetry', t_end=t_end, q0=q0, Nz=Nz, Ny=Ny, Par=Par,
+                        h=h, choice=choice, mode=mode, tol=tol, n_rays=n_rays, methode='RK45')
+        Data = cache.get(key)
+        if Data is not None:
+            print('Endpoints read from cache')
+            if mode == True:
+                return Data['picture'], Data['CM']
+            return Data['picture']
+
     start = time.time()
+    radii = None
     if choice == True:
-        sol = simulate_radius(t_end, Par, q0, h, Nz, Ny, methode = 'RK45', mode = mode)
+        if n_rays is None:
+            sol = simulate_radius(t_end, Par, q0, h, Nz, Ny, methode = 'RK45', mode = mode)
+        else:
+            radii, *sol = simulate_radius_adaptive(t_end, Par, q0, h, Nz, Ny, n_max = n_rays)
         momenta, position = sol
         if mode == True:
             print("calculating constants of motion")
             CM = np.array([DNeg_CM(momenta[:,:,i].T, position[:,:,i].T , Par) for i in range(len(momenta[0,0]))])
-        position = position[:,:,-1]
+        momenta, position = momenta[:,:,-1], position[:,:,-1]
     else:
-        sol = Simulate_DNeg(Smpl.Sympl_DNeg, Par, h, int(t_end/h), q0, Nz, Ny, '2D', mode, wg.Grid_constr_3D_Sph, True)
+        sol = Simulate_DNeg(Smpl.Sympl_DNeg, Par, h, int(t_end/h), q0, Nz, Ny, '2D', mode, wg.Grid_constr_3D_Sph, True, tol = tol)
         momenta, position = sol[0][-1]
         if mode == True:
             CM = sol[2]
-        position = position.T
+        momenta, position = momenta.T, position.T
     end = time.time()
     print('Tijdsduur = ' + str(end-start))
 
     print('Rotating ray...')
-    picture = rotation_qubits(position, Nz, Ny)
+    picture = rotation_qubits(position, Nz, Ny, radii)
     print('Ray rotated!')
+    if cache is not None:
+        cache.put(key, picture=picture, position=position, momenta=momenta, radii=radii,
+                  CM=CM if mode == True else None)
     if mode == True:
         return picture, CM
     else:
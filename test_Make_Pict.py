@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+import WormholeGraphics as wg
+
+
+def rays(Nz = 7, Ny = 9, seed = 0):
+    # endpoints l, phi, theta of a screen of rays on both sides of the wormhole
+    rng = np.random.default_rng(seed)
+    return np.array([rng.uniform(-5, 5, (Nz, Ny)),
+                     rng.uniform(0, 2*np.pi, (Nz, Ny)),
+                     rng.uniform(0, np.pi, (Nz, Ny))])
+
+
+def test_default_grid_is_empty():
+    q = rays()
+    Grid = np.zeros(q[0].shape, dtype=bool)
+    assert np.array_equal(wg.Make_Pict(q), wg.Make_Pict_RGBP(q, Grid))
+    assert np.array_equal(wg.Make_Pict_RGBP(q, None), wg.Make_Pict_RGBP(q, Grid))
+
+
+def test_grid_size_mismatch():
+    q = rays()
+    with pytest.raises(ValueError):
+        wg.Make_Pict(q, np.zeros(1, dtype=bool))
+    with pytest.raises(ValueError):
+        wg.Make_Pict_RGBP(q, np.zeros((3, 3), dtype=bool))